@@ -0,0 +1 @@
+"""Micro and pipeline benchmarks, run with `python -m benchmarks.<name>`."""
@@ -0,0 +1,85 @@
+"""Compare the PNG encode profiles on sample sprites.
+
+Without --sprites, synthetic sprites are drawn: flat shapes on a transparent
+background with some noise, which compress roughly like Factorio entities.
+"""
+import io
+import random
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import click
+from PIL import Image, ImageDraw  # type: ignore
+
+from factorio_noir.render import ENCODE_PROFILES
+
+
+def synthetic_sprites(count: int, seed: int) -> List[Image.Image]:
+    rng = random.Random(seed)
+    sprites = []
+
+    for _ in range(count):
+        size = rng.choice([64, 128, 256, 512, 1024])
+        sprite = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(sprite)
+
+        for _ in range(rng.randint(10, 40)):
+            x, y = rng.randrange(size), rng.randrange(size)
+            r = rng.randint(size // 20, size // 4)
+            color = tuple(rng.randrange(256) for _ in range(3)) + (
+                rng.randint(128, 255),
+            )
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+
+        noise = Image.effect_noise((size, size), 20).convert("L")
+        sprite = Image.merge(
+            "RGBA",
+            [
+                Image.blend(channel, noise, 0.1) if i < 3 else channel
+                for i, channel in enumerate(sprite.split())
+            ],
+        )
+        sprites.append(sprite)
+
+    return sprites
+
+
+@click.command()
+@click.option(
+    "--sprites",
+    type=click.Path(exists=True, file_okay=False),
+    help="Directory of sample PNG files to encode instead of synthetic ones.",
+)
+@click.option("--count", default=40, help="Number of synthetic sprites.")
+@click.option("--seed", default=0)
+def main(sprites: Optional[str], count: int, seed: int) -> None:
+    if sprites is not None:
+        samples = [
+            Image.open(p).convert("RGBA")
+            for p in sorted(Path(sprites).glob("**/*.png"))
+        ]
+    else:
+        samples = synthetic_sprites(count, seed)
+
+    pixels = sum(s.width * s.height for s in samples)
+    click.echo(f"{len(samples)} sprites, {pixels / 1e6:.1f} Mpixels")
+
+    for name, options in ENCODE_PROFILES.items():
+        start = time.perf_counter()
+        written = 0
+
+        for sample in samples:
+            output = io.BytesIO()
+            sample.save(output, format="PNG", **options)
+            written += len(output.getvalue())
+
+        elapsed = time.perf_counter() - start
+        click.echo(
+            f"{name:>8}: {elapsed * 1000:8.1f}ms  {written / 2**20:8.2f}MiB  "
+            f"({pixels / elapsed / 1e6:.1f} Mpixels/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
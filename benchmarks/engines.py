@@ -0,0 +1,62 @@
+"""Check the transform engines against the Pillow one, and time them."""
+import time
+from typing import Dict, List, Optional
+
+import click
+from PIL import Image, ImageChops  # type: ignore
+
+from benchmarks.encode import synthetic_sprites
+from factorio_noir.category import SpriteTreatment
+from factorio_noir.render import TRANSFORM_ENGINES
+
+TREATMENTS = [
+    SpriteTreatment.from_yaml({"saturation": "10%", "brightness": "70%"}),
+    SpriteTreatment.from_yaml({"saturation": "35%", "brightness": "70%", "hue": "5%"}),
+    SpriteTreatment.from_yaml(
+        {
+            "saturation": "40%",
+            "brightness": "80%",
+            "tiling": ["1 0.5 0", "0 0.25 1"],
+        }
+    ),
+]
+
+
+def max_difference(image1: Image.Image, image2: Image.Image) -> int:
+    extrema = ImageChops.difference(image1, image2).getextrema()
+    return max(high for _, high in extrema)
+
+
+@click.command()
+@click.option("--count", default=20, help="Number of synthetic sprites.")
+@click.option("--tolerance", default=1, help="Maximum allowed channel difference.")
+@click.option("--seed", default=0)
+def main(count: int, tolerance: int, seed: int) -> None:
+    sprites = synthetic_sprites(count, seed)
+    timings: Dict[str, float] = {name: 0.0 for name in TRANSFORM_ENGINES}
+    worst = 0
+
+    for treatment in TREATMENTS:
+        for bright in (False, True):
+            for sprite in sprites:
+                results = {}
+                for name, transform in TRANSFORM_ENGINES.items():
+                    start = time.perf_counter()
+                    results[name] = transform(sprite, treatment, bright)
+                    timings[name] += time.perf_counter() - start
+
+                for name, result in results.items():
+                    worst = max(worst, max_difference(results["pillow"], result))
+
+    for name, elapsed in timings.items():
+        click.echo(f"{name:>8}: {elapsed * 1000:8.1f}ms")
+
+    if worst > tolerance:
+        raise click.ClickException(
+            f"Engines differ by up to {worst}, more than the tolerance of {tolerance}"
+        )
+    click.secho(f"All engines match within {worst}", fg="green")
+
+
+if __name__ == "__main__":
+    main()
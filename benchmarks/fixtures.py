@@ -0,0 +1,148 @@
+"""Synthetic Factorio install, mods and pack, to benchmark without the game.
+
+The layout mirrors the real one: a data directory holding the "core" and
+"base" mods as plain directories, a mods directory of zipped mods, and a pack
+of YAML categories shaped like packs/Vanilla.
+"""
+import io
+import json
+import random
+import zipfile
+from pathlib import Path
+from typing import List, Tuple
+
+from PIL import Image, ImageDraw  # type: ignore
+
+# (name, frame size, columns, rows) of the sheets of each entity, hr sheets
+# being twice as large. The biggest ones are 2048x2048, like the real base mod.
+SHEETS = [
+    ("", 64, 8, 4),
+    ("-shadow", 64, 8, 4),
+    ("-mask", 32, 8, 4),
+    ("-animation", 128, 8, 8),
+]
+
+ENTITY_KINDS = ["assembling-machine", "inserter", "transport-belt", "turret", "pipe"]
+
+
+def spritesheet(rng: random.Random, frame_size: int, columns: int, rows: int) -> bytes:
+    """Draw a PNG spritesheet of simple shapes over a transparent background."""
+    sheet = Image.new("RGBA", (frame_size * columns, frame_size * rows), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(sheet)
+
+    base_color = [rng.randrange(256) for _ in range(3)]
+    for row in range(rows):
+        for column in range(columns):
+            x, y = column * frame_size, row * frame_size
+            for _ in range(3):
+                color = tuple(
+                    min(255, max(0, c + rng.randint(-40, 40))) for c in base_color
+                )
+                box = sorted(rng.sample(range(frame_size), 2))
+                draw.rectangle(
+                    (x + box[0], y + box[0], x + box[1], y + box[1]),
+                    fill=color + (rng.randint(160, 255),),
+                )
+
+    # Some texture, so that the PNG doesn't compress unrealistically well
+    noise = Image.effect_noise(sheet.size, 6).convert("L")
+    r, g, b, a = sheet.split()
+    sheet = Image.merge(
+        "RGBA", (Image.blend(r, noise, 0.15), Image.blend(g, noise, 0.15), b, a)
+    )
+
+    output = io.BytesIO()
+    sheet.save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
+
+def entity_files(
+    rng: random.Random, entity_count: int, prefix: str
+) -> List[Tuple[str, bytes]]:
+    files = []
+    for e in range(entity_count):
+        entity = f"{ENTITY_KINDS[e % len(ENTITY_KINDS)]}-{e}"
+        for suffix, frame_size, columns, rows in SHEETS:
+            for hr, scale in (("", 1), ("hr-", 2)):
+                files.append(
+                    (
+                        f"{prefix}graphics/entity/{entity}/{hr}{entity}{suffix}.png",
+                        spritesheet(rng, frame_size * scale, columns, rows),
+                    )
+                )
+    return files
+
+
+def icon_files(
+    rng: random.Random, icon_count: int, prefix: str
+) -> List[Tuple[str, bytes]]:
+    return [
+        (f"{prefix}graphics/icons/icon-{i}.png", spritesheet(rng, 64, 1, 1))
+        for i in range(icon_count)
+    ]
+
+
+def generate_fixtures(root: Path, scale: int, seed: int) -> Tuple[Path, Path, Path]:
+    """Write the fixtures under root, returns the data, mods and pack dirs."""
+    rng = random.Random(seed)
+    data_dir, mods_dir, pack_dir = root / "data", root / "mods", root / "pack"
+
+    for mod_name in ("core", "base"):
+        mod_dir = data_dir / mod_name
+        mod_dir.mkdir(parents=True, exist_ok=True)
+        (mod_dir / "info.json").write_text(json.dumps({"name": mod_name}))
+
+    base_files = entity_files(rng, 4 * scale, "") + icon_files(rng, 40 * scale, "")
+    core_files = icon_files(rng, 10 * scale, "")
+    for mod_name, files in (("base", base_files), ("core", core_files)):
+        for path, data in files:
+            target = data_dir / mod_name / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(data)
+
+    mods_dir.mkdir(parents=True, exist_ok=True)
+    for m in range(scale):
+        mod_name = f"SyntheticMod{m}"
+        # Older versions next to the newest one, like a real mods directory
+        for version in ("1.0.0", "1.1.0"):
+            root_dir = f"{mod_name}_{version}/"
+            with zipfile.ZipFile(mods_dir / f"{mod_name}_{version}.zip", "w") as zfile:
+                zfile.writestr(root_dir + "info.json", json.dumps({"name": mod_name}))
+                if version != "1.1.0":
+                    continue
+
+                for path, data in entity_files(rng, 2, root_dir) + icon_files(
+                    rng, 10, root_dir
+                ):
+                    # Mod authors use both, so both code paths get exercised
+                    compress_type = rng.choice(
+                        [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]
+                    )
+                    zfile.writestr(path, data, compress_type=compress_type)
+
+    (pack_dir / "base").mkdir(parents=True, exist_ok=True)
+    (pack_dir / "mods").mkdir(parents=True, exist_ok=True)
+    (pack_dir / "core.yml").write_text(
+        "treatment:\n  brightness: 70%\n  saturation: 10%\n\n"
+        "core:\n  graphics:\n\nexcludes:\n  - icon-1.png\n"
+    )
+    (pack_dir / "base" / "01_entities.yml").write_text(
+        "treatment:\n  brightness: 70%\n  saturation: 35%\n\n"
+        "base:\n  graphics:\n    entity:\n\nexcludes:\n  - shadow\n  - mask\n"
+    )
+    (pack_dir / "base" / "02_icons.yml").write_text(
+        "treatment:\n  brightness: 80%\n  saturation: 50%\n"
+        "  tiling:\n    - 1 0.5\n    - 0.5 1\n\n"
+        "base:\n  graphics:\n    icons:\n"
+    )
+    (pack_dir / "base" / "03_shadows.yml").write_text(
+        "treatment:\n  brightness: 50%\n  saturation: 0%\n\n"
+        "base:\n  graphics:\n    entity:\n      - shadow\n      - mask\n"
+    )
+    for m in range(scale):
+        (pack_dir / "mods" / f"mod{m}.yml").write_text(
+            "treatment:\n  brightness: 60%\n  saturation: 20%\n\n"
+            f"SyntheticMod{m}:\n  graphics:\n"
+        )
+
+    return data_dir, mods_dir, pack_dir
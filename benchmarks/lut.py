@@ -0,0 +1,100 @@
+"""Compare the throughput of 3D LUTs with the color matrix path.
+
+Each treatment is rendered by the pillow engine and through its LUT, as the
+lut engine does. The pillow engine applies a plain matrix with convert(),
+adds a point() table for contrast, gamma and curve, and only uses the LUT
+for per hue saturation, which has no cheaper Pillow operation.
+"""
+import time
+from typing import Callable, List
+
+import click
+from PIL import Image, ImageChops  # type: ignore
+
+from benchmarks.encode import synthetic_sprites
+from factorio_noir.category import SpriteTreatment
+from factorio_noir.render import (
+    LUT_SIZE,
+    apply_transforms,
+    apply_transforms_lut,
+    treatment_lut,
+)
+
+TREATMENTS = {
+    "matrix": SpriteTreatment.from_yaml(
+        {"saturation": "35%", "brightness": "70%", "hue": "5%"}
+    ),
+    "tonal": SpriteTreatment.from_yaml(
+        {
+            "saturation": "35%",
+            "brightness": "70%",
+            "contrast": "120%",
+            "gamma": 1.2,
+            "curve": ["0 0", "0.25 0.15", "0.75 0.85", "1 1"],
+        }
+    ),
+    "per hue": SpriteTreatment.from_yaml(
+        {
+            "saturation": "35%",
+            "brightness": "70%",
+            "hue_saturation": {"red": "150%", "blue": "50%"},
+            "contrast": "120%",
+        }
+    ),
+}
+
+
+def throughput(
+    sprites: List[Image.Image], render: Callable[[Image.Image], Image.Image]
+) -> float:
+    """Rendered megapixels per second."""
+    pixels = sum(sprite.width * sprite.height for sprite in sprites)
+
+    start = time.perf_counter()
+    for sprite in sprites:
+        render(sprite)
+
+    return pixels / (time.perf_counter() - start) / 1e6
+
+
+def max_difference(image1: Image.Image, image2: Image.Image) -> int:
+    extrema = ImageChops.difference(image1, image2).getextrema()
+    return max(high for _, high in extrema)
+
+
+@click.command()
+@click.option("--count", default=40, help="Number of synthetic sprites.")
+@click.option("--seed", default=0)
+def main(count: int, seed: int) -> None:
+    sprites = synthetic_sprites(count, seed)
+
+    click.echo(f"{'':>8}  {'compile':>8}  {'pillow':>12}  {'LUT':>12}  difference")
+    for name, treatment in TREATMENTS.items():
+        start = time.perf_counter()
+        treatment_lut(treatment, False)
+        compile_time = time.perf_counter() - start
+
+        pillow = throughput(
+            sprites, lambda sprite: apply_transforms(sprite, treatment, False)
+        )
+        lut = throughput(
+            sprites, lambda sprite: apply_transforms_lut(sprite, treatment, False)
+        )
+        worst = max(
+            max_difference(
+                apply_transforms(sprite, treatment, False),
+                apply_transforms_lut(sprite, treatment, False),
+            )
+            for sprite in sprites
+        )
+
+        click.echo(
+            f"{name:>8}  {compile_time:7.2f}s  {pillow:7.1f} Mpx/s  {lut:7.1f} Mpx/s"
+            f"  {worst}"
+        )
+
+    click.echo(f"LUTs have {LUT_SIZE}^3 points")
+
+
+if __name__ == "__main__":
+    main()
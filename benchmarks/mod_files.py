@@ -0,0 +1,88 @@
+"""Compare PathTrie globbing with the per file filter_check scan.
+
+The file list is synthetic but shaped like the base mod: a few hundred
+entity directories, each holding normal and hr sprites, shadows and masks.
+"""
+import random
+import time
+from pathlib import Path
+from typing import Callable, Iterable, List, Set, Tuple
+
+import click
+
+from factorio_noir.mod import PathTrie, filter_check
+
+
+def vanilla_like_files(entity_count: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    files = []
+
+    for e in range(entity_count):
+        entity = f"entity-{e}"
+        for variant in range(rng.randint(5, 40)):
+            for kind in ("", "-shadow", "-mask", "-light"):
+                name = f"{entity}{kind}-{variant}.png"
+                files.append(f"graphics/entity/{entity}/{name}")
+                files.append(f"graphics/entity/{entity}/hr-{name}")
+
+    for i in range(entity_count * 10):
+        files.append(f"graphics/icons/icon-{i}.png")
+        files.append(f"graphics/terrain/tile-{i % 50}/tile-{i}.png")
+        files.append(f"graphics/decorative/deco-{i % 30}/deco-{i}.png")
+
+    return files
+
+
+def vanilla_like_patterns(entity_count: int) -> List[Path]:
+    patterns = [
+        Path("graphics") / "entity" / f"entity-{e}" / "**" / "*.png"
+        for e in range(0, entity_count, 3)
+    ]
+    patterns += [
+        Path("graphics") / "**" / "*shadow*.png",
+        Path("graphics") / "icons" / "**" / "*.png",
+        Path("graphics") / "terrain" / "**" / "*tile-1*.png",
+        Path("**") / "decorative" / "**" / "*.png",
+    ]
+    return patterns
+
+
+def scan(files: Iterable[str], pattern: Path) -> Set[str]:
+    return {f for f in files if filter_check(f.split("/"), pattern.parts)}
+
+
+def timed(func: Callable[[], Set[str]]) -> Tuple[float, Set[str]]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+@click.command()
+@click.option("--entities", default=300, help="Number of entity directories.")
+@click.option("--seed", default=0)
+def main(entities: int, seed: int) -> None:
+    files = vanilla_like_files(entities, seed)
+    patterns = vanilla_like_patterns(entities)
+    click.echo(f"{len(files)} files, {len(patterns)} patterns")
+
+    build_time, trie = timed(lambda: PathTrie(files))  # type: ignore
+    click.echo(f"Trie build:    {build_time * 1000:8.1f}ms")
+
+    scan_total = trie_total = 0.0
+    for pattern in patterns:
+        scan_time, expected = timed(lambda: scan(files, pattern))
+        trie_time, found = timed(lambda: trie.glob(pattern.parts))  # type: ignore
+
+        if found != expected:
+            raise click.ClickException(f"Results differ for pattern {pattern}")
+
+        scan_total += scan_time
+        trie_total += trie_time
+
+    click.echo(f"fnmatch scan:  {scan_total * 1000:8.1f}ms")
+    click.echo(f"Trie glob:     {trie_total * 1000:8.1f}ms")
+    click.secho(f"Speedup: {scan_total / (trie_total + build_time):.1f}x", fg="green")
+
+
+if __name__ == "__main__":
+    main()
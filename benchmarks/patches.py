@@ -0,0 +1,163 @@
+"""Check the data.raw patches in config.lua against the full walk, and time them.
+
+data-final-fixes.lua is mirrored in Python: the generated config.lua is
+parsed back, then its patches are applied to one copy of a synthetic
+data.raw while the other copy is walked. Some prototypes are left out of the
+dump and others moved a sprite after it, so that both fallbacks to the walk
+run. Prototypes referencing sprites the dump doesn't know about are not
+supported, the dump must come from the same set of mods.
+"""
+import copy
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import click
+
+from benchmarks.raw_parse import write_dump
+from factorio_noir.lua import serpent
+from factorio_noir.lua.patches import DataRawIndex
+from factorio_noir.lua.raw_store import RawStore, file_references
+from factorio_noir.lua.serpent import lua_string
+
+PACK_NAME = "factorio-noir"
+
+Raw = Dict[str, Dict[str, Any]]
+
+
+def replacement(item: str) -> str:
+    return f"__{PACK_NAME}__/data/{item}"
+
+
+def check_data(table: Dict[Any, Any], assets: Dict[str, Any]) -> None:
+    """checkData from data-final-fixes.lua."""
+    for key, item in table.items():
+        if isinstance(item, str):
+            if item in assets:
+                table[key] = replacement(item)
+        elif isinstance(item, dict):
+            check_data(item, assets)
+
+
+def patch_prototype(prototype: Dict[Any, Any], patches: Dict[float, Any]) -> bool:
+    """patchPrototype from data-final-fixes.lua, Lua arrays parse as dicts."""
+    for index in range(1, len(patches) + 1):
+        patch = patches[float(index)]
+        fields = [patch[float(i)] for i in range(1, len(patch) + 1)]
+
+        parent = prototype
+        for field in fields[:-2]:
+            parent = parent.get(field)
+            if not isinstance(parent, dict):
+                return False
+
+        key, item = fields[-2], fields[-1]
+        if parent.get(key) != item:
+            return False
+        parent[key] = replacement(item)
+
+    return True
+
+
+def apply_config(raw: Raw, config: Dict[str, Any]) -> None:
+    """The main chunk of data-final-fixes.lua."""
+    for type_name, prototypes in raw.items():
+        dumped = config["dumped_prototypes"].get(type_name, {})
+        type_patches = config["patches"].get(type_name, {})
+
+        for name, prototype in prototypes.items():
+            if name not in dumped:
+                check_data(prototype, config["updated_assets"])
+            elif name in type_patches:
+                if not patch_prototype(prototype, type_patches[name]):
+                    check_data(prototype, config["updated_assets"])
+
+
+def config_lua(index: DataRawIndex, assets: List[str]) -> str:
+    """config.lua, as gen_pack_files writes it."""
+    config = f"return {{\n    resource_pack_name = {lua_string(PACK_NAME)},\n"
+    config += "    updated_assets = {\n"
+    config += "".join(f"[{lua_string(asset)}]=1,\n" for asset in assets)
+    config += "    },\n"
+    config += index.lua_config(assets)
+    config += "}\n"
+    return config
+
+
+def timed(func: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--size", default=5, help="Size of the dump in MiB.")
+@click.option("--seed", default=0)
+def main(size: int, seed: int) -> None:
+    rng = random.Random(seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dump = Path(tmp_dir) / "raw.txt"
+        write_dump(dump, size * 2 ** 20, seed)
+        raw = serpent.load(dump)
+
+        # The game has prototypes the dump misses, and some that changed since
+        dumped = {
+            prototype_type: {
+                name: prototype
+                for name, prototype in prototypes.items()
+                if rng.random() > 0.05
+            }
+            for prototype_type, prototypes in raw.items()
+        }
+        store_path = Path(tmp_dir) / "raw.sqlite"
+        RawStore.create(store_path, dumped).close()
+        index = DataRawIndex.load(store_path)
+
+    changed = 0
+    for prototypes in raw.values():
+        for prototype in prototypes.values():
+            if rng.random() < 0.05:
+                # Same sprite, but not where the dump has it anymore
+                layer = prototype["animation"]["layers"][1.0]
+                prototype["animation"] = {"filename": layer["filename"]}
+                changed += 1
+
+    filenames = sorted(
+        {
+            filename
+            for prototypes in raw.values()
+            for prototype in prototypes.values()
+            for filename, _ in file_references(prototype)
+        }
+    )
+    assets = rng.sample(filenames, len(filenames) // 2)
+
+    config_source = config_lua(index, sorted(assets))
+    config = serpent.loads(config_source)
+    click.echo(
+        f"{sum(len(p) for p in raw.values())} prototypes, {len(assets)} assets, "
+        f"config.lua is {len(config_source) / 2 ** 20:.1f} MiB"
+    )
+
+    walked = copy.deepcopy(raw)
+    patched = copy.deepcopy(raw)
+
+    walk_time = timed(lambda: check_data(walked, config["updated_assets"]))
+    patch_time = timed(lambda: apply_config(patched, config))
+    click.echo(f"  walk: {walk_time:.3f}s")
+    click.echo(f"  patches: {patch_time:.3f}s")
+
+    if walked != patched:
+        raise click.ClickException("The patches don't give the same data.raw")
+    click.secho(
+        f"The patches give the same data.raw as the walk ({changed} prototypes "
+        "changed after the dump)",
+        fg="green",
+    )
+
+
+if __name__ == "__main__":
+    main()
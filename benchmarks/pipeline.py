@@ -0,0 +1,214 @@
+"""Time each stage of the build pipeline on synthetic fixtures.
+
+Stages run one after the other in a single process, so that each one can be
+measured on its own. Results are written as JSON; give a previous result with
+--compare to flag the stages that got slower.
+"""
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+from PIL import Image  # type: ignore
+
+from benchmarks.fixtures import generate_fixtures
+from factorio_noir import mod
+from factorio_noir.category import SpriteCategory, SpriteTreatment
+from factorio_noir.mod import LazyFile, Mod, find_mod
+from factorio_noir.output import ZipOutput
+from factorio_noir.render import ENCODE_PROFILES, TRANSFORM_ENGINES
+
+# Stages slower by less than this many seconds are timing noise, not regressions
+NOISE_FLOOR = 0.05
+
+
+def run_stages(
+    data_dir: Path, mods_dir: Path, pack_dir: Path, engine: str, encode: str
+) -> Tuple[Dict[str, float], Dict[str, int]]:
+    source_dirs = [data_dir, mods_dir]
+    stages: Dict[str, float] = {}
+    counts: Dict[str, int] = {}
+
+    # Mod indexing, from scratch
+    mod.use_mod_index(None)
+    mod.global_mod_cache.clear()
+    mod_names = ["core", "base"] + sorted(
+        p.name.split("_")[0] for p in mods_dir.glob("*_1.1.0.zip")
+    )
+
+    start = time.perf_counter()
+    for mod_name in mod_names:
+        mod.global_mod_cache[mod_name] = Mod(mod_name, find_mod(mod_name, source_dirs))
+    stages["mod_indexing"] = time.perf_counter() - start
+    counts["mods"] = len(mod_names)
+
+    # Category loading and sprite discovery
+    start = time.perf_counter()
+    categories = [
+        SpriteCategory.from_yaml(category_file, source_dirs)
+        for category_file in sorted(pack_dir.glob("**/*.yml"))
+    ]
+    sprites: List[Tuple[LazyFile, SpriteTreatment, str]] = [
+        (source, category.treatment, lua_path)
+        for category in categories
+        for source, _, lua_path in category.sprite_files()
+    ]
+    stages["discovery"] = time.perf_counter() - start
+    counts["sprites"] = len(sprites)
+
+    decoded = []
+    start = time.perf_counter()
+    for source, treatment, lua_path in sprites:
+        with source.open() as source_file:
+            decoded.append(
+                (Image.open(source_file).convert("RGBA"), treatment, lua_path)
+            )
+    stages["decode"] = time.perf_counter() - start
+    counts["pixels"] = sum(image.width * image.height for image, _, _ in decoded)
+
+    transformed = []
+    start = time.perf_counter()
+    for image, treatment, lua_path in decoded:
+        transformed.append(
+            (TRANSFORM_ENGINES[engine](image, treatment, False), lua_path)
+        )
+    stages["transform"] = time.perf_counter() - start
+    del decoded
+
+    encoded = []
+    start = time.perf_counter()
+    for image, lua_path in transformed:
+        output = io.BytesIO()
+        image.save(output, format="PNG", **ENCODE_PROFILES[encode])
+        encoded.append((output.getvalue(), lua_path))
+    stages["encode"] = time.perf_counter() - start
+    counts["bytes_written"] = sum(len(data) for data, _ in encoded)
+    del transformed
+
+    with tempfile.TemporaryDirectory() as archive_dir:
+        start = time.perf_counter()
+        archive = ZipOutput(Path(archive_dir) / "pack.zip", "pack")
+        for data, lua_path in encoded:
+            archive.write(f"data/{lua_path}", data, compress=False)
+        archive.close()
+        stages["archive"] = time.perf_counter() - start
+
+    return stages, counts
+
+
+def compare(
+    stages: Dict[str, float], previous_file: Path, tolerance: float
+) -> List[str]:
+    """List the stages slower than in the previous run, beyond the tolerance."""
+    with previous_file.open() as f:
+        previous = json.load(f)["stages"]
+
+    regressions = []
+    for stage, stage_time in stages.items():
+        if stage not in previous or previous[stage] == 0:
+            continue
+
+        ratio = stage_time / previous[stage]
+        flag = ""
+        if ratio > 1 + tolerance and stage_time - previous[stage] > NOISE_FLOOR:
+            regressions.append(stage)
+            flag = "  <- REGRESSION"
+        click.echo(
+            f"  {stage:>14}: {previous[stage]:7.3f}s -> {stage_time:7.3f}s "
+            f"({ratio:.2f}x){flag}"
+        )
+
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--fixtures",
+    type=click.Path(file_okay=False),
+    help="Where to generate the fixtures, reused if already there. "
+    "Default: a temporary directory",
+)
+@click.option("--scale", default=1, help="Size of the fixtures, roughly linear.")
+@click.option("--seed", default=0)
+@click.option(
+    "--engine", type=click.Choice(sorted(TRANSFORM_ENGINES)), default="pillow"
+)
+@click.option("--encode", type=click.Choice(sorted(ENCODE_PROFILES)), default="default")
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False),
+    default="bench_output.json",
+    help="Where to write the JSON results.",
+)
+@click.option(
+    "--compare",
+    "previous",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Previous JSON results to compare against.",
+)
+@click.option(
+    "--tolerance",
+    default=0.15,
+    help="Relative slowdown allowed before a stage is flagged.",
+)
+def main(
+    fixtures: Optional[str],
+    scale: int,
+    seed: int,
+    engine: str,
+    encode: str,
+    output: str,
+    previous: Optional[str],
+    tolerance: float,
+) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(fixtures) if fixtures is not None else Path(tmp_dir)
+        marker = root / f"fixtures-{scale}-{seed}.done"
+
+        if not marker.exists():
+            click.echo(f"Generating fixtures in {root}")
+            start = time.perf_counter()
+            generate_fixtures(root, scale, seed)
+            marker.touch()
+            click.echo(f"Generated fixtures in {time.perf_counter() - start:.1f}s")
+
+        stages, counts = run_stages(
+            root / "data", root / "mods", root / "pack", engine, encode
+        )
+
+    results: Dict[str, Any] = {
+        "meta": {
+            "scale": scale,
+            "seed": seed,
+            "engine": engine,
+            "encode": encode,
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "stages": stages,
+        "counts": counts,
+    }
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    click.echo(json.dumps(counts))
+    for stage, stage_time in stages.items():
+        click.echo(f"  {stage:>14}: {stage_time:7.3f}s")
+    click.secho(f"Results written to {output}", fg="green")
+
+    if previous is not None:
+        click.echo(f"Compared to {previous}:")
+        regressions = compare(stages, Path(previous), tolerance)
+        if len(regressions) > 0:
+            raise click.ClickException(f"Slower than before: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Compare the serpent parser to luaparser on synthetic data.raw dumps.
+
+The dumps are shaped like serpent.block(data.raw): prototypes grouped by
+type, with nested sprite definitions, arrays, and infinities. luaparser is
+only run on a small dump, it needs minutes and gigabytes on a full one.
+"""
+import multiprocessing
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional, TextIO, Tuple
+
+import click
+
+from factorio_noir.lua import serpent
+from factorio_noir.lua.raw_to_dict import luaparser_load
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported
+    resource = None  # type: ignore
+
+TYPES = ["assembling-machine", "inserter", "transport-belt", "item", "recipe", "tile"]
+
+
+def write_sprite(out: TextIO, rng: random.Random, name: str, indent: str) -> None:
+    out.write(f"{indent}{{\n")
+    out.write(f'{indent}  filename = "__base__/graphics/entity/{name}/{name}.png",\n')
+    out.write(f"{indent}  frame_count = {rng.randint(1, 64)},\n")
+    out.write(f"{indent}  line_length = {rng.randint(1, 8)},\n")
+    out.write(f'{indent}  priority = "high",\n')
+    out.write(f"{indent}  scale = 0.5,\n")
+    out.write(f"{indent}  shift = {{\n")
+    out.write(f"{indent}    {rng.uniform(-2, 2):.17g},\n")
+    out.write(f"{indent}    {rng.uniform(-2, 2):.17g}\n")
+    out.write(f"{indent}  }},\n")
+    out.write(f"{indent}  width = {rng.randint(16, 512)},\n")
+    out.write(f"{indent}  height = {rng.randint(16, 512)}\n")
+    out.write(f"{indent}}}")
+
+
+def write_dump(path: Path, size: int, seed: int) -> None:
+    """Write prototypes until the dump is about size bytes."""
+    rng = random.Random(seed)
+
+    with path.open("w") as out:
+        out.write("raw = {\n")
+        prototype = 0
+        while out.tell() < size:
+            prototype_type = TYPES[prototype % len(TYPES)]
+            out.write(f'  ["{prototype_type}-{prototype}"] = {{\n')
+
+            for _ in range(200):
+                name = f"{prototype_type}-{prototype}"
+                prototype += 1
+
+                out.write(f'    ["{name}"] = {{\n')
+                out.write(f"      max_health = {rng.randint(1, 5000)},\n")
+                out.write(f'      name = "{name}",\n')
+                out.write(f'      type = "{prototype_type}",\n')
+                out.write(f'      localised_description = {{"\\"{name}\\"\\n"}},\n')
+                out.write(f"      stack_size = 1/0,\n")
+                out.write(f'      flags = {{\n        "placeable-neutral",\n')
+                out.write(f'        "player-creation"\n      }},\n')
+                out.write("      animation = {\n        layers = {\n")
+                write_sprite(out, rng, name, "          ")
+                out.write(",\n")
+                write_sprite(out, rng, name + "-shadow", "          ")
+                out.write("\n        }\n      },\n")
+                out.write(f"      resistances = {{\n        {{\n")
+                out.write(f"          decrease = -{rng.randint(0, 10)},\n")
+                out.write(f'          type = "fire"\n        }}\n      }}\n')
+                out.write("    },\n")
+
+            out.write("  },\n")
+        out.write("}\n")
+
+
+def timed_load(load: Callable[[Path], Any], path: Path) -> Tuple[float, Optional[int]]:
+    """Parse in the calling process, returns the time and peak memory in MiB."""
+    start = time.perf_counter()
+    load(path)
+    elapsed = time.perf_counter() - start
+
+    if resource is None:
+        return elapsed, None
+
+    # In KiB on Linux
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def same_results(path: Path) -> bool:
+    # nan != nan, compare the representations instead
+    return repr(serpent.load(path)) == repr(luaparser_load(path))
+
+
+def in_new_process(func: Callable[..., Any], *args: Any) -> Any:
+    """Run func in a fresh process, so that peak memory is its own.
+
+    Parsing is kept out of this process entirely: peak memory carries over
+    to the processes it starts.
+    """
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        return pool.submit(func, *args).result()
+
+
+def run(name: str, load: Callable[[Path], Any], path: Path) -> None:
+    elapsed, peak_memory = in_new_process(timed_load, load, path)
+
+    size = path.stat().st_size / 2 ** 20
+    memory = f", peak memory {peak_memory} MiB" if peak_memory is not None else ""
+    click.echo(
+        f"{name:>10}: {size:7.1f} MiB in {elapsed:7.2f}s "
+        f"({size / elapsed:6.1f} MiB/s{memory})"
+    )
+
+
+@click.command()
+@click.option("--size", default=200, help="Size of the dump in MiB.")
+@click.option(
+    "--luaparser-size",
+    default=1,
+    help="Size of the dump compared with luaparser in MiB, 0 to skip.",
+)
+@click.option("--seed", default=0)
+def main(size: int, luaparser_size: int, seed: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if luaparser_size > 0:
+            small_dump = Path(tmp_dir) / "small.txt"
+            write_dump(small_dump, luaparser_size * 2 ** 20, seed)
+
+            if not in_new_process(same_results, small_dump):
+                raise click.ClickException("The parsers disagree")
+            click.secho("Both parsers give the same result", fg="green")
+
+            run("luaparser", luaparser_load, small_dump)
+            run("serpent", serpent.load, small_dump)
+
+        dump = Path(tmp_dir) / "raw.txt"
+        click.echo(f"Writing a {size} MiB dump")
+        write_dump(dump, size * 2 ** 20, seed)
+        run("serpent", serpent.load, dump)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Compare the peak memory of rendering a large sprite, with and without strips.
+
+The sprite is written and each render runs in a fresh process, so that the
+peak memory of a render is its own.
+"""
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple
+
+import click
+from PIL import Image  # type: ignore
+
+from benchmarks.encode import synthetic_sprites
+from benchmarks.raw_parse import in_new_process
+from factorio_noir.category import SpriteTreatment
+from factorio_noir.mod import LazyFile
+from factorio_noir.render import process_sprite
+
+TREATMENT = SpriteTreatment.from_yaml(
+    {"saturation": "35%", "brightness": "70%", "tiling": ["1 0.5", "0 1"]}
+)
+
+
+def write_sprite(path: Path, size: int) -> None:
+    # Tile a synthetic sprite, drawing a large one takes too long
+    (tile,) = synthetic_sprites(1, 0)
+    sprite = Image.new("RGBA", (size, size))
+    for x in range(0, size, tile.width):
+        for y in range(0, size, tile.height):
+            sprite.paste(tile, (x, y))
+
+    sprite.save(path, compress_level=1)
+
+
+def render(
+    lazy_file: LazyFile, engine: str, strip_threshold: Optional[int]
+) -> Tuple[Optional[int], float, bytes]:
+    """Render in the calling process, returns its peak memory in MiB."""
+    data, stats = process_sprite(
+        lazy_file,
+        None,
+        TREATMENT,
+        False,
+        encode="fast",
+        engine=engine,
+        strip_threshold=strip_threshold,
+    )
+    return stats.peak_memory, stats.transform_time, data
+
+
+@click.command()
+@click.option("--size", default=8192, help="Width and height of the sprite.")
+@click.option("--engine", default="pillow")
+def main(size: int, engine: str) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_new_process(write_sprite, Path(tmp_dir) / "sprite.png", size)
+        lazy_file = LazyFile("file", Path(tmp_dir), "sprite.png", "__test__/sprite.png")
+
+        click.echo(f"{size}x{size} sprite, {engine} engine")
+        results = []
+        for name, strip_threshold in (("whole", None), ("strips", 1)):
+            memory, transform_time, data = in_new_process(
+                render, lazy_file, engine, strip_threshold
+            )
+            results.append(data)
+
+            peak = f", peak memory {memory} MiB" if memory is not None else ""
+            click.echo(f"{name:>8}: transformed in {transform_time:5.2f}s{peak}")
+
+    if results[0] != results[1]:
+        raise click.ClickException("The strips don't give the same sprite")
+    click.secho("The strips give the same sprite", fg="green")
+
+
+if __name__ == "__main__":
+    main()
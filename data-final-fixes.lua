@@ -1,12 +1,15 @@
 local config = require("config")
 
+local function replacement(item)
+	return "__" .. config.resource_pack_name .. "__/data/" .. item
+end
+
 -- replace all files mentioned in the config file
 local function checkData(table)
 	for key, item in pairs(table) do
 		if type(item) == "string" then
 			if config.updated_assets[item] ~= nil then
-				local changed_item_path = "__" .. config.resource_pack_name .. "__/data/" .. item
-				table[key] = changed_item_path
+				table[key] = replacement(item)
 			end
 		elseif type(item) == "table" then
 			checkData(item)
@@ -14,5 +17,44 @@ local function checkData(table)
 	end
 end
 
-checkData(data.raw)
+-- set the fields listed in the config file, each patch is a field path then
+-- the file it holds. Returns false if the prototype changed since the dump.
+local function patchPrototype(prototype, patches)
+	for _, patch in ipairs(patches) do
+		local parent = prototype
+		for i = 1, #patch - 2 do
+			parent = parent[patch[i]]
+			if type(parent) ~= "table" then
+				return false
+			end
+		end
 
+		local key, item = patch[#patch - 1], patch[#patch]
+		if parent[key] ~= item then
+			return false
+		end
+		parent[key] = replacement(item)
+	end
+	return true
+end
+
+if config.patches == nil then
+	checkData(data.raw)
+else
+	-- built with a data.raw dump: only walk what the dump doesn't know about
+	for type_name, prototypes in pairs(data.raw) do
+		local dumped = config.dumped_prototypes[type_name] or {}
+		local type_patches = config.patches[type_name] or {}
+
+		for name, prototype in pairs(prototypes) do
+			if dumped[name] == nil then
+				checkData(prototype)
+			elseif type_patches[name] ~= nil then
+				if not patchPrototype(prototype, type_patches[name]) then
+					-- patched fields are left as they are by the walk
+					checkData(prototype)
+				end
+			end
+		end
+	end
+end
@@ -6,21 +6,46 @@ Notes:
 import json
 import os
 import pprint
-import shutil
 import sys
-import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple
 
 import click
 
+from factorio_noir.cache import RenderCache, render_key
 from factorio_noir.category import SpriteCategory
-from factorio_noir.render import process_sprite
-from factorio_noir.worker import sprite_processor
-from factorio_noir.mod import open_mod_read
+from factorio_noir.lua.patches import DataRawIndex
+from factorio_noir import map_colors, render, timing
+from factorio_noir.render import (
+    ENCODE_PROFILES,
+    TRANSFORM_ENGINES,
+    SpriteStats,
+    process_sprite,
+)
+from factorio_noir.worker import SpriteProcessor, sprite_processor
+from factorio_noir.mod import (
+    global_mod_cache,
+    open_mod_read,
+    save_mod_indexes,
+    use_mod_index,
+)
+from factorio_noir.output import DirectoryOutput, PackOutput, ZipOutput
+from factorio_noir.profile import ProfileReport, WorkerMemory
 
 MOD_ROOT = Path(__file__).parent.parent.resolve()
 
+# Seconds between two checks for changes, with --watch
+WATCH_INTERVAL = 1.0
+
+# How many rendered sprites may wait to be written before submitting blocks
+MAX_UNWRITTEN_SPRITES = 64
+
 VANILLA_MODS = {"core", "base"}
 DEFAULT_FACTORIO_DIRS = [
     str(MOD_ROOT.parent / "data"),
@@ -62,6 +87,18 @@ DEFAULT_MODS_DIR = find_default_dir(DEFAULT_MODS_DIRS)
     "--dry-run", is_flag=True, help="Print out which assets are being modified"
 )
 @click.option("--bright", is_flag=True, help="Add 10 points to all sat/bri values")
+@click.option(
+    "--encode",
+    type=click.Choice(sorted(ENCODE_PROFILES)),
+    help="PNG encoding profile. Default: fast with --dev, default otherwise",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(sorted(TRANSFORM_ENGINES)),
+    default="pillow",
+    help="How the color transforms are computed, numpy is slower and needs NumPy "
+    "installed.\nDefault: pillow",
+)
 @click.option(
     "--factorio-data",
     type=click.Path(exists=True, dir_okay=True, file_okay=False, readable=True),
@@ -84,6 +121,63 @@ DEFAULT_MODS_DIR = find_default_dir(DEFAULT_MODS_DIRS)
     help="The output directory/zip that should be used.\nDefault: <factorio-mods>/",
     envvar="FACTORIO_NOIR_TARGET",
 )
+@click.option(
+    "--cache-dir",
+    type=click.Path(dir_okay=True, file_okay=False),
+    help="Where to keep rendered sprites between builds.\n"
+    f"Default: {MOD_ROOT / '.cache'}",
+    envvar="FACTORIO_NOIR_CACHE",
+    default=str(MOD_ROOT / ".cache"),
+)
+@click.option(
+    "--cache-size",
+    type=int,
+    default=2048,
+    help="Maximum size of the render cache in MiB. Default: 2048",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Render every sprite from scratch, even those --dev finds unchanged",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    help="Number of worker processes. Default: number of CPUs",
+)
+@click.option(
+    "--max-memory",
+    type=click.IntRange(min=1),
+    help="Limit in MiB of the estimated decoded size of sprites queued for the "
+    "workers. Default: no limit",
+)
+@click.option(
+    "--strip-threshold",
+    type=click.IntRange(min=1),
+    default=16,
+    help="Sprites bigger than this many megapixels are transformed in "
+    "horizontal strips, to bound the memory of the workers. Default: 16",
+)
+@click.option(
+    "--profile-report",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the time spent on each rendered sprite to this JSON file, "
+    "with the slowest sprites, categories and mods",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep running, and rebuild the packs whenever their .yml or .lua files "
+    "change. Implies --dev",
+)
+@click.option(
+    "--data-raw",
+    type=click.Path(exists=True, dir_okay=False, readable=True),
+    help="data.raw store written by factorio_noir/lua/raw_to_dict.py. Sprites "
+    "no prototype references are then neither rendered nor shipped, and the "
+    "game only patches the fields referencing the others",
+)
 @click.argument(
     "pack-dirs",
     type=click.Path(exists=True, dir_okay=True, file_okay=False, readable=True),
@@ -91,67 +185,55 @@ DEFAULT_MODS_DIR = find_default_dir(DEFAULT_MODS_DIRS)
     # help="Which packs to load. If missing will process all packs/",
     nargs=-1,
 )
-@click.pass_context
 def cli(
-    ctx: click.Context,
     pack_dirs: List[Path],
     dev: bool,
     dry_run: bool,
     bright: bool,
+    encode: Optional[str],
+    engine: str,
     pack_version: str,
     factorio_data: Optional[Path],
     factorio_mods: Optional[Path],
     target: Optional[Path],
+    cache_dir: str,
+    cache_size: int,
+    no_cache: bool,
+    jobs: Optional[int],
+    max_memory: Optional[int],
+    strip_threshold: int,
+    profile_report: Optional[str],
+    watch: bool,
+    data_raw: Optional[str],
 ):
     if len(pack_dirs) == 0:
         click.secho("Processing all packs!")
         pack_dirs = sorted((MOD_ROOT / "packs").iterdir())
 
-    if len(pack_dirs) > 1:
-        for p in pack_dirs:
-            ctx.invoke(
-                cli,
-                pack_dirs=[p],
-                dev=dev,
-                dry_run=dry_run,
-                bright=bright,
-                pack_version=pack_version,
-                factorio_data=factorio_data,
-                factorio_mods=factorio_mods,
-                target=target,
-            )
-        return
-
-    pack_dir = pack_dirs[0]
-    is_vanilla = Path(pack_dir).name.lower() == "vanilla"
-
-    pack_name = "factorio-noir"
-    if not is_vanilla:
-        pack_name += f"-{Path(pack_dir).name}"
-
     mods_dirs = []
-    if is_vanilla:
-        if factorio_data is None:
-            click.secho(
-                "Missing --factorio-data value, required for editing vanilla graphics.",
-                fg="red",
-            )
-            raise click.Abort
-
-    else:
-        if factorio_mods is None:
-            click.secho(
-                "Missing --factorio-mods value, required for editing mod graphics.",
-                fg="red",
-            )
-            raise click.Abort
 
     if dry_run:
         click.secho("Doing a dry run. No files will be modified")
 
+    if watch:
+        if dry_run:
+            click.secho("--watch can't be used with --dry-run.", fg="red")
+            raise click.Abort
+
+        # Only the sprites that changed are written to the dev directories
+        dev = True
+
     if bright:
         click.secho("Increasing the brightness/saturation a little")
 
+    if encode is None:
+        encode = "fast" if dev else "default"
+    click.secho(f"Using PNG encoding profile: {encode}", fg="blue")
+
+    if engine == "numpy" and render.np is None:
+        click.secho("The numpy engine requires NumPy to be installed.", fg="red")
+        raise click.Abort
+
     if factorio_data is not None:
         factorio_data = Path(factorio_data)
         if any(not (factorio_data / mod).exists() for mod in VANILLA_MODS):
@@ -168,6 +250,260 @@ def cli(
         click.secho(f"Using mods directory: {factorio_mods}", fg="blue")
         mods_dirs.append(Path(factorio_mods))
 
+    builds = [
+        prepare_pack(
+            Path(pack_dir),
+            pack_version,
+            factorio_data,
+            factorio_mods,
+            target,
+            dev,
+            dry_run,
+            reuse=not no_cache,
+        )
+        for pack_dir in pack_dirs
+    ]
+
+    # Mod listings are indexed next to the render cache, keyed by mtime and size
+    use_mod_index(None if no_cache else Path(cache_dir) / "mod-index")
+
+    # Load everything up front, so a broken pack fails before any rendering
+    pack_categories = load_categories([build.pack_dir for build in builds], mods_dirs)
+    save_mod_indexes()
+
+    data_raw_index = None
+    if data_raw is not None:
+        data_raw_index = DataRawIndex.load(
+            Path(data_raw), map_colors=any(build.is_vanilla for build in builds)
+        )
+        click.secho(
+            f"Using data.raw store: {data_raw} "
+            f"({len(data_raw_index.references)} files referenced)",
+            fg="blue",
+        )
+
+    cache = None
+    if not no_cache and not dry_run:
+        click.secho(f"Using render cache: {cache_dir}", fg="blue")
+        cache = RenderCache(Path(cache_dir), cache_size * 2 ** 20)
+
+    profile = None
+    if profile_report is not None:
+        profile = ProfileReport()
+    memory = WorkerMemory()
+
+    # All packs share the same worker pool. Each pack is written in the
+    # background as its sprites are rendered, one pack after the other.
+    if max_memory is not None:
+        max_memory *= 2 ** 20
+
+    render_sprite = partial(process_sprite, strip_threshold=strip_threshold * 10 ** 6)
+
+    with sprite_processor(
+        render_sprite, jobs, max_memory
+    ) as submit, ThreadPoolExecutor(max_workers=1) as archiver:
+        archives = []
+
+        try:
+            for build, categories in zip(builds, pack_categories):
+                pending = PendingSprites()
+                archives.append(
+                    archiver.submit(
+                        finish_pack, build, pending, cache, profile, memory
+                    )
+                )
+
+                try:
+                    gen_pack_files(
+                        build.pack_dir,
+                        categories,
+                        mods_dirs,
+                        build.output,
+                        build.pack_name,
+                        pack_version,
+                        build.is_vanilla,
+                        bright,
+                        encode,
+                        engine,
+                        submit,
+                        pending,
+                        cache,
+                        data_raw_index,
+                    )
+                    # Don't keep the last sprites of the pack waiting for the next
+                    submit.flush()
+                except BaseException as e:
+                    # Its finish_pack aborts it
+                    pending.close(e)
+                    raise
+                pending.close()
+
+        except BaseException:
+            # finish_pack aborts the packs it was given, abort the others. The
+            # failed one may already have cached sprites written to its output.
+            for build in builds[len(archives) :]:
+                if build.output is not None:
+                    build.output.abort()
+            raise
+
+        # The fingerprints of the sources, hashed while gathering the sprites
+        save_mod_indexes()
+
+        for archive in archives:
+            archive.result()
+
+        if watch:
+            watch_packs(
+                builds,
+                pack_categories,
+                mods_dirs,
+                pack_version,
+                bright,
+                encode,
+                engine,
+                submit,
+                archiver,
+                cache,
+                data_raw_index,
+            )
+
+    if cache is not None:
+        cache.evict()
+        cache.report()
+
+    memory.report()
+
+    if profile is not None:
+        profile.write(Path(profile_report))
+
+
+@dataclass
+class PackBuild:
+    """Where a single pack gets built."""
+
+    pack_dir: Path
+    pack_name: str
+    is_vanilla: bool
+    # None for dry runs
+    output: Optional[PackOutput]
+
+
+@dataclass
+class PendingSprite:
+    """A submitted sprite, and every path its render goes to."""
+
+    key: str
+    paths: List[str]
+    # Only used for the profile report
+    category: str
+    mod: str
+
+
+RenderedSprite = Tuple["Future[Tuple[bytes, SpriteStats]]", PendingSprite]
+
+
+class PendingSprites:
+    """The sprites of a pack, handed to its writer as soon as they are rendered.
+
+    The writer iterates over them while the rest of the pack is still being
+    submitted. Adding a sprite blocks while too many rendered ones wait to be
+    written, so that they don't pile up in memory.
+    """
+
+    def __init__(self, max_unwritten: int = MAX_UNWRITTEN_SPRITES):
+        self.max_unwritten = max_unwritten
+
+        self._rendered: Deque[RenderedSprite] = deque()
+        self._added = 0
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+
+    def add(
+        self, future: "Future[Tuple[bytes, SpriteStats]]", sprite: PendingSprite
+    ) -> None:
+        """Hand a submitted sprite to the writer, once it has room for it."""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._error is not None
+                or len(self._rendered) < self.max_unwritten
+            )
+            if self._error is not None:
+                raise self._error
+            self._added += 1
+
+        future.add_done_callback(partial(self._rendered_sprite, sprite))
+
+    def _rendered_sprite(
+        self, sprite: PendingSprite, future: "Future[Tuple[bytes, SpriteStats]]"
+    ) -> None:
+        with self._condition:
+            self._rendered.append((future, sprite))
+            self._condition.notify_all()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        """No more sprites will be added, or stop both sides on an error."""
+        with self._condition:
+            self._closed = True
+            if error is not None and self._error is None:
+                self._error = error
+            self._condition.notify_all()
+
+    def __iter__(self) -> Iterator[RenderedSprite]:
+        """The sprites in rendering order, until all the added ones are done."""
+        taken = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._error is not None
+                    or len(self._rendered) > 0
+                    or (self._closed and taken == self._added)
+                )
+                if self._error is not None:
+                    raise self._error
+                if len(self._rendered) == 0:
+                    return
+
+                rendered = self._rendered.popleft()
+                self._condition.notify_all()
+
+            taken += 1
+            yield rendered
+
+
+def prepare_pack(
+    pack_dir: Path,
+    pack_version: str,
+    factorio_data: Optional[Path],
+    factorio_mods: Optional[Path],
+    target: Optional[Path],
+    dev: bool,
+    dry_run: bool,
+    reuse: bool = True,
+) -> PackBuild:
+    """Check the options needed by a pack and prepare its target directory."""
+    is_vanilla = pack_dir.name.lower() == "vanilla"
+
+    pack_name = "factorio-noir"
+    if not is_vanilla:
+        pack_name += f"-{pack_dir.name}"
+
+    if is_vanilla:
+        if factorio_data is None:
+            click.secho(
+                "Missing --factorio-data value, required for editing vanilla graphics.",
+                fg="red",
+            )
+            raise click.Abort
+
+    else:
+        if factorio_mods is None:
+            click.secho(
+                "Missing --factorio-mods value, required for editing mod graphics.",
+                fg="red",
+            )
+            raise click.Abort
+
     if target is not None:
         final_target_dir = Path(target) / pack_name
     elif factorio_mods is not None:
@@ -181,6 +517,8 @@ def cli(
 
     click.secho(f"Using final target dir: {final_target_dir}", fg="blue")
 
+    output: Optional[PackOutput] = None
+
     if dev is True:
         target_dir = final_target_dir
 
@@ -190,74 +528,259 @@ def cli(
             if target_dir.exists() and not target_dir.is_dir():
                 click.secho("  - Not a directory, deleting it", fg="yellow")
                 target_dir.unlink()
-            elif target_dir.exists():
-                click.secho("  - Emptying directory", fg="yellow")
-                for f in target_dir.iterdir():
-                    if f.is_file():
-                        f.unlink()
-                    else:
-                        shutil.rmtree(f)
 
+            # Only the sprites that changed get written, see DirectoryOutput
             target_dir.mkdir(exist_ok=True, parents=True)
+            output = DirectoryOutput(target_dir, reuse)
 
-    else:
-        target_dir = Path(tempfile.mkdtemp()) / f"{pack_name}_{pack_version}"
-        if not dry_run:
-            target_dir.mkdir(exist_ok=True, parents=True)
-        click.echo(f"Created temporary directory: {target_dir}")
-
-    gen_pack_files(
-        pack_dir,
-        mods_dirs,
-        target_dir,
-        pack_name,
-        pack_version,
-        is_vanilla,
-        dry_run,
-        bright,
-    )
+    elif not dry_run:
+        zip_name = f"{pack_name}_{pack_version}"
+        output = ZipOutput(final_target_dir.parent / f"{zip_name}.zip", zip_name)
+        click.echo(f"Writing archive: {output.location}")
 
-    if dev is True:
+    return PackBuild(pack_dir, pack_name, is_vanilla, output)
+
+
+def finish_pack(
+    build: PackBuild,
+    pending: PendingSprites,
+    cache: Optional[RenderCache],
+    profile: Optional[ProfileReport] = None,
+    memory: Optional[WorkerMemory] = None,
+) -> None:
+    """Write the sprites of a pack as they are rendered, then close it."""
+    if build.output is None:
         return
 
-    click.echo("Making ZIP package")
-    zip_loc = final_target_dir.parent / f"{pack_name}_{pack_version}"
+    try:
+        for future, sprite in pending:
+            data, stats = future.result()
 
-    if not dry_run:
-        zip_loc.parent.mkdir(parents=True, exist_ok=True)
-        archive_name = shutil.make_archive(
-            str(zip_loc),
-            format="zip",
-            root_dir=target_dir.parent,
-            base_dir=target_dir.name,
-        )
+            for path in sprite.paths:
+                build.output.write(path, data, compress=False, fingerprint=sprite.key)
+
+            if cache is not None:
+                cache.store(sprite.key, data)
 
+            if profile is not None:
+                # Output paths are the Lua paths under data/
+                lua_path = sprite.paths[0][len("data/") :]
+                profile.add(lua_path, sprite.category, sprite.mod, stats)
+
+            if memory is not None:
+                memory.add(stats)
+
+    except BaseException as e:
+        # Stop submitting the rest of the pack
+        pending.close(e)
+        build.output.abort()
+        raise
+
+    build.output.close()
     click.secho(
-        f"Created archive for pack: {archive_name}",
+        f"Created pack {build.pack_name}: {build.output.location}",
         fg="green",
     )
-    click.secho("Removing temp dir, and cleaning up.", fg="yellow")
-    if not dry_run:
-        shutil.rmtree(target_dir)
+
+
+def watched_files(pack_dirs: List[Path]) -> Dict[Path, int]:
+    """The files that --watch reacts to, with their modification time."""
+    files = [MOD_ROOT / "data-final-fixes.lua"]
+    for pack_dir in pack_dirs:
+        files.extend(pack_dir.glob("**/*.yml"))
+        files.extend(pack_dir.glob("**/*.lua"))
+
+    mtimes = {}
+    for path in files:
+        try:
+            mtimes[path] = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            # Removed while we were listing
+            pass
+
+    return mtimes
+
+
+def watch_packs(
+    builds: List["PackBuild"],
+    pack_categories: List[List[SpriteCategory]],
+    source_dirs: List[Path],
+    pack_version: str,
+    bright: bool,
+    encode: str,
+    engine: str,
+    submit: SpriteProcessor,
+    writer: ThreadPoolExecutor,
+    cache: Optional[RenderCache],
+    data_raw: Optional[DataRawIndex] = None,
+) -> None:
+    """Rebuild the packs whose files change, until interrupted.
+
+    The worker pool and the mods stay loaded. Only the categories whose file
+    changed are read again, and the dev directory being synced, only sprites
+    whose category or treatment changed are rendered.
+    """
+    categories = {
+        build.pack_dir: {category.source: category for category in pack}
+        for build, pack in zip(builds, pack_categories)
+    }
+    snapshot = watched_files([build.pack_dir for build in builds])
+
+    click.secho("Watching for changes, press Ctrl-C to stop", fg="blue")
+    # Ctrl-C is the way to stop, let the build clean up after it
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+
+            new_snapshot = watched_files([build.pack_dir for build in builds])
+            changed = {
+                path
+                for path in snapshot.keys() | new_snapshot.keys()
+                if snapshot.get(path) != new_snapshot.get(path)
+            }
+            snapshot = new_snapshot
+
+            for build in builds:
+                pack_changed = {
+                    path
+                    for path in changed
+                    if build.pack_dir in path.parents or path.parent == MOD_ROOT
+                }
+                if len(pack_changed) == 0:
+                    continue
+
+                start_time = time.perf_counter()
+                try:
+                    rebuild = False
+                    for path in sorted(pack_changed):
+                        if path.suffix == ".lua":
+                            click.echo(f"Changed: {path}")
+                            rebuild = True
+                            continue
+
+                        if path not in new_snapshot:
+                            categories[build.pack_dir].pop(path, None)
+                            click.echo(f"Removed category: {path}")
+                            rebuild = True
+                            continue
+
+                        # Until the edit parses, the old category stays in use
+                        old_category = categories[build.pack_dir].get(path)
+                        new_category = SpriteCategory.from_yaml(path, source_dirs)
+                        categories[build.pack_dir][path] = new_category
+                        if new_category != old_category:
+                            click.echo(f"Changed category: {path}")
+                            rebuild = True
+
+                    if not rebuild:
+                        continue
+
+                    # A new output, to sync against the manifest of the last build
+                    assert isinstance(build.output, DirectoryOutput)
+                    build.output = DirectoryOutput(
+                        build.output.location, build.output.reuse
+                    )
+
+                    pending = PendingSprites()
+                    written = writer.submit(finish_pack, build, pending, cache)
+                    try:
+                        gen_pack_files(
+                            build.pack_dir,
+                            list(categories[build.pack_dir].values()),
+                            source_dirs,
+                            build.output,
+                            build.pack_name,
+                            pack_version,
+                            build.is_vanilla,
+                            bright,
+                            encode,
+                            engine,
+                            submit,
+                            pending,
+                            cache,
+                            data_raw,
+                        )
+                        submit.flush()
+                    except BaseException as e:
+                        # Keep the manifest true to the cached sprites already
+                        # written, finish_pack aborts the output
+                        pending.close(e)
+                        wait([written])
+                        raise
+                    pending.close()
+                    save_mod_indexes()
+                    written.result()
+
+                except (Exception, click.Abort) as e:
+                    click.secho(f"Failed to rebuild {build.pack_name}: {e}", fg="red")
+                    submit.reset_error()
+                    continue
+
+                rebuild_time = time.perf_counter() - start_time
+                click.secho(
+                    f"Rebuilt {build.pack_name} in {rebuild_time:.1f}s", fg="green"
+                )
+    except KeyboardInterrupt:
+        click.secho("Stopped watching", fg="blue")
+
+
+def load_categories(
+    pack_dirs: List[Path], source_dirs: List[Path]
+) -> List[List[SpriteCategory]]:
+    """Load all the categories of each pack directory.
+
+    YAML parsing, mod resolution and mod indexing are IO bound, they are all
+    done on a thread pool.
+    """
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor() as loader:
+        pack_futures = []
+        for pack_dir in pack_dirs:
+            click.echo(f"Loading categories for pack: {pack_dir}")
+            pack_futures.append(
+                [
+                    loader.submit(SpriteCategory.from_yaml, category_file, source_dirs)
+                    for category_file in Path(pack_dir).glob("**/*.yml")
+                ]
+            )
+
+        pack_categories = [
+            [future.result() for future in futures] for futures in pack_futures
+        ]
+
+    timing.report(
+        f"Loaded {sum(len(c) for c in pack_categories)} categories "
+        f"and {len(global_mod_cache)} mods",
+        time.perf_counter() - start_time,
+    )
+
+    return pack_categories
 
 
 def gen_pack_files(
     pack_dir: Path,
+    categories: List[SpriteCategory],
     source_dirs: List[Path],
-    target_dir: Path,
+    output: Optional[PackOutput],
     pack_name: str,
     pack_version: str,
     is_vanilla: bool,
-    dry_run: bool,
     bright: bool,
+    encode: str,
+    engine: str,
+    submit: SpriteProcessor,
+    pending: PendingSprites,
+    cache: Optional[RenderCache] = None,
+    data_raw: Optional[DataRawIndex] = None,
 ) -> None:
-    """Generate a Factorio-Noir package from pack directory."""
-    click.echo(f"Loading categories for pack: {pack_dir}")
-    categories = [
-        SpriteCategory.from_yaml(category_file, source_dirs)
-        for category_file in Path(pack_dir).glob("**/*.yml")
-    ]
+    """Generate a Factorio-Noir package from pack directory.
 
+    Sprites are only submitted for rendering, they are added to the pending
+    sprites, whose writer completes the package. With a data.raw
+    index, the sprites matched by the categories but used by no prototype
+    are left out, and config.lua lists the fields to patch.
+    """
     lua_includes = sorted(Path(pack_dir).glob("**/*.lua"))
 
     used_mods = {m for c in categories for m in c.mods}
@@ -268,17 +791,16 @@ def gen_pack_files(
 
     click.secho("Prepared all mods, now adding info.json and other files.", fg="green")
 
-    if not dry_run:
-        with (target_dir / "data-final-fixes.lua").open("w") as data_final_fixes_file:
-            with (MOD_ROOT / "data-final-fixes.lua").open("r") as lua_file:
-                data_final_fixes_file.write(lua_file.read())
+    if output is not None:
+        with (MOD_ROOT / "data-final-fixes.lua").open("r") as lua_file:
+            data_final_fixes = lua_file.read()
 
-            for lua_include in lua_includes:
-                with lua_include.open("r") as lua_file:
-                    data_final_fixes_file.write(
-                        f"\n\n-- {lua_include.relative_to(pack_dir)}:\n\n"
-                    )
-                    data_final_fixes_file.write(lua_file.read())
+        for lua_include in lua_includes:
+            with lua_include.open("r") as lua_file:
+                data_final_fixes += f"\n\n-- {lua_include.relative_to(pack_dir)}:\n\n"
+                data_final_fixes += lua_file.read()
+
+        output.write("data-final-fixes.lua", data_final_fixes.encode("utf-8"))
 
     click.echo("Patching the info.json file")
     with (MOD_ROOT / "info.json").open() as file:
@@ -295,9 +817,11 @@ def gen_pack_files(
 
     info_file["dependencies"].extend(used_mods - VANILLA_MODS)
 
-    if not dry_run:
-        with (target_dir / "info.json").open("w") as file:
-            json.dump(info_file, file, indent=4, sort_keys=True)
+    if output is not None:
+        output.write(
+            "info.json",
+            json.dumps(info_file, indent=4, sort_keys=True).encode("utf-8"),
+        )
     else:
         click.echo(
             "New info.json: %s" % json.dumps(info_file, indent=4, sort_keys=True)
@@ -306,76 +830,160 @@ def gen_pack_files(
     click.echo("Starting to process sprites")
     marked_for_processing: Dict[str, str] = {}
 
-    with sprite_processor(process_sprite) as submit:
-        with click.progressbar(categories, label="Make sprites tasks") as progress:
-            for category in progress:
-                for (
-                    lazy_source_file,
-                    lazy_match_size_file,
-                    lua_path,
-                ) in category.sprite_files():
-                    if lua_path in marked_for_processing:
-                        click.echo()
-                        click.secho(
-                            f"The sprite {lua_path} was included in processing "
-                            f"from more than one category: \n"
-                            f"    {str(category.source.relative_to(pack_dir))}\n"
-                            f"    {marked_for_processing[lua_path]}",
-                            fg="red",
-                        )
-                        raise click.Abort()
-                    marked_for_processing[lua_path] = str(
-                        category.source.relative_to(pack_dir)
+    # Identical sources with the same treatment are only rendered once
+    renders: Dict[str, PendingSprite] = {}
+    duplicates = 0
+
+    # Matched by a category, but referenced by no prototype
+    referenced_files = data_raw.filenames() if data_raw is not None else None
+    unreferenced: Set[str] = set()
+    unreferenced_size = 0
+
+    # Sprites to render, with their pixel count and the arguments to render them
+    to_render: List[Tuple[int, PendingSprite, Dict[str, Any]]] = []
+
+    with click.progressbar(categories, label="Make sprites tasks") as progress:
+        for category in progress:
+            for (
+                lazy_source_file,
+                lazy_match_size_file,
+                lua_path,
+            ) in category.sprite_files():
+                # The engine loads some core sprites directly, never prune them
+                if (
+                    referenced_files is not None
+                    and lua_path not in referenced_files
+                    and not lua_path.startswith("__core__/")
+                ):
+                    unreferenced.add(lua_path)
+                    unreferenced_size += lazy_source_file.size()
+                    continue
+
+                if lua_path in marked_for_processing:
+                    click.echo()
+                    click.secho(
+                        f"The sprite {lua_path} was included in processing "
+                        f"from more than one category: \n"
+                        f"    {str(category.source.relative_to(pack_dir))}\n"
+                        f"    {marked_for_processing[lua_path]}",
+                        fg="red",
                     )
-
-                    if not dry_run:
-                        # We want lazy access to the file because contextmanager seralizes
-                        # the file with pickel
-                        submit(
-                            lazy_source_file=lazy_source_file,
-                            lazy_match_size_file=lazy_match_size_file,
-                            target_file_path=target_dir / "data" / lua_path,
-                            treatment=category.treatment,
-                            bright=bright,
+                    raise click.Abort()
+                marked_for_processing[lua_path] = str(
+                    category.source.relative_to(pack_dir)
+                )
+
+                if output is not None:
+                    new_size = None
+                    if lazy_match_size_file is not None:
+                        new_size = lazy_match_size_file.png_header().size
+
+                    key = render_key(
+                        lazy_source_file,
+                        new_size,
+                        category.treatment,
+                        bright,
+                        encode,
+                        engine,
+                    )
+                    if output.is_current(f"data/{lua_path}", key):
+                        continue
+
+                    if key in renders:
+                        renders[key].paths.append(f"data/{lua_path}")
+                        duplicates += 1
+                        continue
+
+                    if cache is not None:
+                        cached_sprite = cache.fetch(key)
+                        if cached_sprite is not None:
+                            output.write(
+                                f"data/{lua_path}",
+                                cached_sprite,
+                                compress=False,
+                                fingerprint=key,
+                            )
+                            continue
+
+                    renders[key] = PendingSprite(
+                        key,
+                        [f"data/{lua_path}"],
+                        f"{pack_name}/{marked_for_processing[lua_path]}",
+                        lazy_source_file.lua_path.split("__")[1],
+                    )
+                    to_render.append(
+                        (
+                            lazy_source_file.png_header().pixels,
+                            renders[key],
+                            # We want lazy access to the file because contextmanager
+                            # seralizes the file with pickel
+                            dict(
+                                lazy_source_file=lazy_source_file,
+                                new_size=new_size,
+                                treatment=category.treatment,
+                                bright=bright,
+                                encode=encode,
+                                engine=engine,
+                            ),
                         )
+                    )
 
-                for lua_path, file_path in category.copy_files.items():
-                    if lua_path in marked_for_processing:
-                        click.echo()
-                        click.secho(
-                            f"The sprite {lua_path} was included in processing "
-                            f"from more than one category: \n"
-                            f"    {str(category.source.relative_to(pack_dir))}\n"
-                            f"    {marked_for_processing[lua_path]}",
-                            fg="red",
-                        )
-                        raise click.Abort()
-                    marked_for_processing[lua_path] = str(
-                        category.source.relative_to(pack_dir)
+            for lua_path, file_path in category.copy_files.items():
+                if lua_path in marked_for_processing:
+                    click.echo()
+                    click.secho(
+                        f"The sprite {lua_path} was included in processing "
+                        f"from more than one category: \n"
+                        f"    {str(category.source.relative_to(pack_dir))}\n"
+                        f"    {marked_for_processing[lua_path]}",
+                        fg="red",
                     )
+                    raise click.Abort()
+                marked_for_processing[lua_path] = str(
+                    category.source.relative_to(pack_dir)
+                )
 
-                    if not dry_run:
-                        target_file_path = target_dir / "data" / lua_path
-                        target_file_path.parent.mkdir(exist_ok=True, parents=True)
-                        shutil.copy(file_path, target_file_path)
+                if output is not None:
+                    output.copy(f"data/{lua_path}", file_path)
 
-    if not dry_run:
+    if len(unreferenced) > 0:
+        click.secho(
+            f"Pruned {len(unreferenced)} sprites not referenced by data.raw "
+            f"({unreferenced_size / 2 ** 20:.1f} MiB of sources)",
+            fg="green",
+        )
+
+    if duplicates > 0:
+        click.secho(
+            f"Skipped {duplicates} renders of sprites identical to another one",
+            fg="green",
+        )
+
+    if output is not None:
         # inform lua which files need to be replaced
-        with (target_dir / "config.lua").open("w") as file:
-            file.write(
-                """
+        config = (
+            """
     return {
         resource_pack_name = "%s",
         updated_assets = {
     """
-                % pack_name
-            )
+            % pack_name
+        )
 
-            for asset in sorted(marked_for_processing.keys()):
-                file.write('["%s"]=1,\n' % asset)
+        for asset in sorted(marked_for_processing.keys()):
+            config += '["%s"]=1,\n' % asset
+
+        config += "    },\n"
+        if data_raw is not None:
+            config += data_raw.lua_config(marked_for_processing)
+        if is_vanilla:
+            # For desaturate_map.lua
+            config += map_colors.lua_config(
+                data_raw.map_colors if data_raw is not None else None
+            )
+        config += "}\n"
 
-            file.write("    },\n")
-            file.write("}\n")
+        output.write("config.lua", config.encode("utf-8"))
 
     else:
         for mod_name in sorted(used_mods):
@@ -389,7 +997,19 @@ def gen_pack_files(
             ):
                 lua_path = f"__{mod_name}__/{f}"
 
-                click.secho(f"  {marked_for_processing.get(lua_path, '<unused>')}: {f}")
+                if lua_path in unreferenced:
+                    usage = "<unreferenced>"
+                else:
+                    usage = marked_for_processing.get(lua_path, "<unused>")
+                click.secho(f"  {usage}: {f}")
+
+    # The writer of the pack writes to the output from now on. Biggest sprites
+    # first, so that no huge spritesheet is left rendering alone at the end.
+    to_render.sort(key=lambda task: task[0], reverse=True)
+    for pixels, sprite, task in to_render:
+        # Decoded as RGBA, 4 bytes per pixel
+        future = submit(cost=4 * pixels, **task)
+        pending.add(future, sprite)
 
 
 if __name__ == "__main__":
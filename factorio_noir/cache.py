@@ -0,0 +1,124 @@
+"""Persistent on-disk cache of rendered sprites, shared across builds."""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import attr
+import click
+
+from factorio_noir.category import SpriteTreatment
+from factorio_noir.mod import LazyFile
+
+# Bump this whenever render.py changes the pixels it outputs, so that
+# sprites rendered by an older version are never reused.
+RENDERER_VERSION = 2
+
+
+def render_key(
+    lazy_source_file: LazyFile,
+    new_size: Optional[Tuple[int, int]],
+    treatment: SpriteTreatment,
+    bright: bool,
+    encode: str,
+    engine: str,
+) -> str:
+    """Compute the key of a sprite render from everything it depends on.
+
+    Only the content of the files is used, not their path, so that identical
+    sprites shipped under different paths share the same render.
+    """
+    identity = {
+        "renderer": RENDERER_VERSION,
+        "source": lazy_source_file.fingerprint(),
+        "new_size": new_size,
+        "treatment": attr.asdict(treatment),
+        "bright": bright,
+        "encode": encode,
+        "engine": engine,
+    }
+
+    return hashlib.sha1(
+        json.dumps(identity, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class RenderCache:
+    """Content addressed store of rendered sprites with LRU eviction."""
+
+    cache_dir: Path
+    max_size: int
+    hits: int
+    misses: int
+
+    def __init__(self, cache_dir: Path, max_size: int):
+        self.cache_dir = cache_dir / "renders"
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.png"
+
+    def fetch(self, key: str) -> Optional[bytes]:
+        """Read a cached render, returns None on a cache miss."""
+        cached_file = self.path(key)
+
+        try:
+            data = cached_file.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used for the LRU eviction
+        os.utime(cached_file)
+
+        self.hits += 1
+        return data
+
+    def store(self, key: str, data: bytes) -> None:
+        """Add a freshly rendered sprite to the cache."""
+        cached_file = self.path(key)
+        cached_file.parent.mkdir(exist_ok=True, parents=True)
+
+        # Write then rename, so a killed build never leaves a truncated entry
+        tmp_file = cached_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, cached_file)
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits max_size."""
+        entries: List[Tuple[float, int, Path]] = []
+        total_size = 0
+
+        for cached_file in self.cache_dir.glob("*/*.png"):
+            stat = cached_file.stat()
+            entries.append((stat.st_mtime, stat.st_size, cached_file))
+            total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        evicted = 0
+        for _, size, cached_file in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            cached_file.unlink()
+            total_size -= size
+            evicted += 1
+
+        click.secho(
+            f"Evicted {evicted} sprites from the render cache "
+            f"({total_size / 2**20:.1f} MiB left)",
+            fg="yellow",
+        )
+
+    def report(self) -> None:
+        click.secho(
+            f"Render cache: {self.hits} hits, {self.misses} misses",
+            fg="green",
+        )
@@ -1,7 +1,10 @@
 """A sprite category described in a YAML file."""
-from fnmatch import fnmatch
+from fnmatch import translate
 import itertools
+import os
 import pprint
+import re
+import threading
 from pathlib import Path
 from typing import Any, Dict, Iterable, List, Set, Tuple, Union, Optional
 
@@ -11,8 +14,18 @@ from attr import converters
 from ruamel.yaml import YAML  # type: ignore
 
 from factorio_noir.mod import Mod, LazyFile, open_mod_read
+from factorio_noir.timing import timed
 
-SAFE_PARSER = YAML(typ="safe")
+# ruamel keeps its parsing state on the YAML instance, categories are loaded
+# from a thread pool so each thread gets its own parser
+_parsers = threading.local()
+
+
+def safe_parser() -> YAML:
+    """The safe YAML parser of the calling thread."""
+    if not hasattr(_parsers, "safe"):
+        _parsers.safe = YAML(typ="safe")
+    return _parsers.safe
 
 
 def _float_or_percent(val: Union[float, str]) -> float:
@@ -47,6 +60,9 @@ def _validate_tiling(inst: Any, attr: Any, value: List[List[float]]) -> None:
     if min(len(t) for t in value) != max(len(t) for t in value):
         raise ValueError("Tiling must have the same number of column for each row.")
 
+    if any(not 0 <= t <= 1 for row in value for t in row):
+        raise ValueError("Tiling strengths must be between 0 and 1")
+
 
 def _parse_tiling(value: Optional[List[str]]) -> List[List[float]]:
     # Tiling is read as a list of strings to make it be layed out graphically
@@ -57,9 +73,143 @@ def _parse_tiling(value: Optional[List[str]]) -> List[List[float]]:
         return [[float(t) for t in row.split()] for row in value]
 
 
+def _parse_curve(value: Optional[List[str]]) -> List[Tuple[float, float]]:
+    # Points of the curve, "input output" with both in [0, 1]
+    if value is None:
+        return []
+
+    points = []
+    for point in value:
+        x, y = (float(c) for c in point.split())
+        points.append((x, y))
+    return sorted(points)
+
+
+def _validate_curve(inst: Any, attr: Any, value: List[Tuple[float, float]]) -> None:
+    """Ensure the curve is valid."""
+    if len(value) == 1:
+        raise ValueError("Curve must have at least 2 points")
+
+    if any(not 0 <= c <= 1 for point in value for c in point):
+        raise ValueError("Curve points must be between 0 and 1")
+
+
+def _validate_contrast(inst: Any, attr: Any, value: float) -> None:
+    if value < 0:
+        raise ValueError("Contrast must not be negative")
+
+
+def _validate_gamma(inst: Any, attr: Any, value: float) -> None:
+    if value <= 0:
+        raise ValueError("Gamma must be greater than 0")
+
+
+# Hues of the hue_saturation keys, in turns from red
+HUES = {
+    "red": 0 / 6,
+    "yellow": 1 / 6,
+    "green": 2 / 6,
+    "cyan": 3 / 6,
+    "blue": 4 / 6,
+    "magenta": 5 / 6,
+}
+
+
+def _hue_saturation(value: Optional[Dict[str, Union[float, str]]]) -> Dict[str, float]:
+    if value is None:
+        return {}
+
+    unknown = set(value) - set(HUES)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown hues {sorted(unknown)}, must be among {list(HUES)}")
+
+    return {hue: _float_or_percent(saturation) for hue, saturation in value.items()}
+
+
 TileSet = Iterable[Tuple[Tuple[int, int, int, int], float]]
 
 
+def tile_boxes(tiling: Iterable[Iterable[float]], width: int, height: int) -> TileSet:
+    """Yield the bounding box of each tile in a sprite, with its strength."""
+    rows = [list(row) for row in tiling]
+    y_count = len(rows)
+    for y_index, y_tile in enumerate(rows):
+
+        x_count = len(y_tile)
+        for x_index, tile_strength in enumerate(y_tile):
+
+            # Doing multiplication before devision here to make sure rounding is correct
+            bounding_box = (
+                # from (x1, y1)
+                int(width * x_index / x_count),
+                int(height * y_index / y_count),
+                # to (x2, y2)
+                int(width * (x_index + 1) / x_count),
+                int(height * (y_index + 1) / y_count),
+            )
+
+            yield bounding_box, tile_strength
+
+
+def _compile_any(patterns: List[str]) -> Optional["re.Pattern[str]"]:
+    """Compile fnmatch patterns into one regex matching any of them."""
+    if len(patterns) == 0:
+        return None
+
+    return re.compile(
+        "|".join(translate(os.path.normcase(pattern)) for pattern in patterns)
+    )
+
+
+class PathMatcher:
+    """The excludes, includes and replaces of a category, each compiled once."""
+
+    def __init__(
+        self, excludes: List[str], includes: List[str], replaces: Dict[str, str]
+    ):
+        self._excludes = _compile_any([f"*{exclude}*" for exclude in excludes])
+        self._includes = _compile_any([f"*{include}*" for include in includes])
+
+        self._replaces = list(replaces.items())
+        self._replace_finder = None
+        if len(self._replaces) > 0:
+            self._replace_finder = re.compile(
+                "|".join(re.escape(find) for find, _ in self._replaces)
+            )
+
+    def excluded(self, sprite_path: str) -> bool:
+        """Whether the path matches any of the excludes."""
+        if self._excludes is None:
+            return False
+
+        return self._excludes.match(os.path.normcase(sprite_path)) is not None
+
+    def included(self, sprite_path: str) -> bool:
+        """Whether the path matches any of the includes, or there are none."""
+        if self._includes is None:
+            return True
+
+        return self._includes.match(os.path.normcase(sprite_path)) is not None
+
+    def replace(self, full_sprite_path: str) -> str:
+        """Apply the replaces, in order, to a path."""
+        # Most paths contain none of the replaced strings
+        if self._replace_finder is None or not self._replace_finder.search(
+            full_sprite_path
+        ):
+            return full_sprite_path
+
+        # Replacements apply to the output of the previous ones, keep that
+        for find, replace in self._replaces:
+            full_sprite_path = full_sprite_path.replace(find, replace)
+
+        return full_sprite_path
+
+
+# Numbers taken from factorio's shader, also used for the map colors
+DEFAULT_COLOR_SPACE = [0.3086, 0.6094, 0.0820]
+
+
 @attr.s(auto_attribs=True)
 class SpriteTreatment:
     """Describe the treatment to execute on a given sprite."""
@@ -72,6 +222,18 @@ class SpriteTreatment:
         converter=_parse_tiling,
         validator=_validate_tiling,
     )
+    # Nonlinear steps, applied in this order after the color matrix. Per hue
+    # saturation is rendered through a 3D lookup table, see render.py.
+    hue_saturation: Dict[str, float] = attr.ib(default=None, converter=_hue_saturation)
+    contrast: float = attr.ib(
+        default=1.0, converter=_float_or_percent, validator=_validate_contrast
+    )
+    gamma: float = attr.ib(default=1.0, converter=float, validator=_validate_gamma)
+    curve: List[Tuple[float, float]] = attr.ib(
+        default=None, converter=_parse_curve, validator=_validate_curve
+    )
+    # Blur radius in pixels of the edges between tiles, 0 for sharp edges
+    tile_smoothing: float = attr.ib(default=0.0, converter=float)
 
     @classmethod
     def from_yaml(cls, yaml_fragment: Dict[str, Any]) -> "SpriteTreatment":
@@ -82,29 +244,32 @@ class SpriteTreatment:
             brightness=yaml_fragment["brightness"],
             hue=yaml_fragment.get("hue", 0.0),
             tiling=yaml_fragment.get("tiling"),
-            # Numbers taken from factorio's shader. Keep in sync with data-final-fixes.lua
-            color_space=yaml_fragment.get("color_space", [0.3086, 0.6094, 0.0820]),
+            color_space=yaml_fragment.get("color_space", DEFAULT_COLOR_SPACE),
+            hue_saturation=yaml_fragment.get("hue_saturation"),
+            contrast=yaml_fragment.get("contrast", 1.0),
+            gamma=yaml_fragment.get("gamma", 1.0),
+            curve=yaml_fragment.get("curve"),
+            tile_smoothing=yaml_fragment.get("tile_smoothing", 0.0),
         )
 
+    @property
+    def per_hue(self) -> bool:
+        """Whether the saturation depends on the hue."""
+        return any(saturation != 1 for saturation in self.hue_saturation.values())
+
+    @property
+    def tonal(self) -> bool:
+        """Whether each channel goes through a tone curve after the matrix."""
+        return self.contrast != 1 or self.gamma != 1 or len(self.curve) > 0
+
+    @property
+    def tiled(self) -> bool:
+        """Whether some tiles are not fully converted."""
+        return any(tile_strength != 1 for row in self.tiling for tile_strength in row)
+
     def tiles(self, width: int, height: int) -> TileSet:
         """Yield each tile in the sprite, with the given strength to apply."""
-        y_count = len(self.tiling)
-        for y_index, y_tile in enumerate(self.tiling):
-
-            x_count = len(y_tile)
-            for x_index, tile_strength in enumerate(y_tile):
-
-                # Doing multiplication before devision here to make sure rounding is correct
-                bounding_box = (
-                    # from (x1, y1)
-                    int(width * x_index / x_count),
-                    int(height * y_index / y_count),
-                    # to (x2, y2)
-                    int(width * (x_index + 1) / x_count),
-                    int(height * (y_index + 1) / y_count),
-                )
-
-                yield bounding_box, tile_strength
+        return tile_boxes(self.tiling, width, height)
 
 
 @attr.s(auto_attribs=True)
@@ -121,11 +286,20 @@ class SpriteCategory:
     replaces: Dict[str, str]
     copy_files: Dict[str, Path]
     forced_assets: List[str]
+    matcher: PathMatcher = attr.ib(init=False, eq=False, repr=False)
+    resolved_mods: Dict[str, Mod] = attr.ib(
+        init=False, eq=False, repr=False, factory=dict
+    )
+
+    @matcher.default
+    def _compile_matcher(self) -> PathMatcher:
+        return PathMatcher(self.excludes, self.includes, self.replaces)
 
     @classmethod
     def from_yaml(cls, yaml_path: Path, source_dirs: List[Path]) -> "SpriteCategory":
         """Read the sprite category to do from a yaml fragment."""
-        definition = SAFE_PARSER.load(yaml_path)
+        with timed("yaml parsing"):
+            definition = safe_parser().load(yaml_path)
         try:
             treatment = SpriteTreatment.from_yaml(definition.pop("treatment"))
         except ValueError as e:
@@ -195,18 +369,12 @@ class SpriteCategory:
 
             for sprite_path in mod.files(pattern):
                 # But they should not match any of the excludes
-                if any(
-                    fnmatch(sprite_path, f"*{exclude}*") for exclude in self.excludes
-                ):
+                if self.matcher.excluded(sprite_path):
                     continue
 
-                if len(self.includes) > 0:
-                    # They must contain an includes
-                    if all(
-                        not fnmatch(sprite_path, f"*{include}*")
-                        for include in self.includes
-                    ):
-                        continue
+                # They must contain an includes
+                if not self.matcher.included(sprite_path):
+                    continue
 
                 full_sprite_path = f"__{mod.name}__/{sprite_path}"
 
@@ -219,10 +387,7 @@ class SpriteCategory:
                     lazy_match_size_file = mod.lazy_file(sprite_path)
 
                     # Double check the excludes still don't match
-                    if any(
-                        fnmatch(replaced_sprite_path, f"*{exclude}*")
-                        for exclude in self.excludes
-                    ):
+                    if self.matcher.excluded(replaced_sprite_path):
                         continue
 
                 try:
@@ -265,14 +430,15 @@ class SpriteCategory:
             yield (lazy_source_file, None, asset)
 
     def replace_path(self, full_sprite_path: str) -> Tuple[Mod, str]:
-        new_path = full_sprite_path
-        for find, replace in self.replaces.items():
-            new_path = new_path.replace(find, replace)
+        new_path = self.matcher.replace(full_sprite_path)
 
         new_mod_name, new_sprite_path = new_path.split("/", 1)
 
-        # remove '__' srounding the mod name
-        assert new_mod_name[:2] == "__" and new_mod_name[-2:] == "__"
-        new_mod_name = new_mod_name[2:-2]
+        if new_mod_name not in self.resolved_mods:
+            # remove '__' srounding the mod name
+            assert new_mod_name[:2] == "__" and new_mod_name[-2:] == "__"
+            self.resolved_mods[new_mod_name] = open_mod_read(
+                new_mod_name[2:-2], self.source_dirs
+            )
 
-        return open_mod_read(new_mod_name, self.source_dirs), new_sprite_path
+        return self.resolved_mods[new_mod_name], new_sprite_path
@@ -0,0 +1,88 @@
+"""Precomputed patches of data.raw, applied by data-final-fixes.lua.
+
+Without them, data-final-fixes.lua walks the whole data.raw at game load to
+find the strings naming an updated asset. With a data.raw store, the build
+knows in advance which field of which prototype references each asset, and
+config.lua lists them so that only those fields are set. Prototypes missing
+from the dump, added by mods it didn't include, are still walked.
+"""
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, DefaultDict, Dict, Iterable, List, Optional, Set, Tuple
+
+from factorio_noir.lua.raw_store import FieldPath, RawStore
+from factorio_noir.map_colors import ColorPatch, color_patches
+from factorio_noir.lua.serpent import lua_string, lua_value
+
+# A field path followed by the asset it currently holds
+Patch = Tuple[Any, ...]
+
+Patches = Dict[str, Dict[str, List[Patch]]]
+
+
+@dataclass
+class DataRawIndex:
+    """What the build needs from a data.raw store, loaded once."""
+
+    # Names of the prototypes in the dump, by type
+    prototypes: Dict[str, List[str]]
+    # Prototypes and fields referencing each file
+    references: Dict[str, List[Tuple[str, str, FieldPath]]]
+    # The desaturated map colors, only loaded for the Vanilla pack
+    map_colors: Optional[List[ColorPatch]] = None
+
+    @classmethod
+    def load(cls, db_path: Path, map_colors: bool = False) -> "DataRawIndex":
+        references: DefaultDict[str, List[Tuple[str, str, FieldPath]]]
+        references = defaultdict(list)
+
+        with RawStore(db_path) as store:
+            prototypes = {
+                prototype_type: store.names(prototype_type)
+                for prototype_type in store.types()
+            }
+            for filename, prototype_type, name, field_path in store.references():
+                references[filename].append((prototype_type, name, field_path))
+
+            colors = color_patches(store) if map_colors else None
+
+        return cls(prototypes, dict(references), colors)
+
+    def filenames(self) -> Set[str]:
+        """All the files referenced by at least one prototype."""
+        return set(self.references)
+
+    def patches(self, assets: Iterable[str]) -> Patches:
+        """The fields to set for the given assets, by prototype type and name."""
+        patches: Patches = {}
+        for asset in sorted(assets):
+            for prototype_type, name, field_path in self.references.get(asset, []):
+                patches.setdefault(prototype_type, {}).setdefault(name, []).append(
+                    field_path + (asset,)
+                )
+        return patches
+
+    def lua_config(self, assets: Iterable[str]) -> str:
+        """The config.lua fields listing the patches and the dumped prototypes."""
+        lines = ["    patches = {"]
+        for prototype_type, prototypes in sorted(self.patches(assets).items()):
+            lines.append(f"        [{lua_string(prototype_type)}] = {{")
+            for name, patches in sorted(prototypes.items()):
+                lines.append(f"            [{lua_string(name)}] = {{")
+                for patch in patches:
+                    fields = ", ".join(lua_value(field) for field in patch)
+                    lines.append(f"                {{{fields}}},")
+                lines.append("            },")
+            lines.append("        },")
+        lines.append("    },")
+
+        # Prototypes absent from the dump are the only ones left to walk
+        lines.append("    dumped_prototypes = {")
+        for prototype_type, names in sorted(self.prototypes.items()):
+            lines.append(f"        [{lua_string(prototype_type)}] = {{")
+            lines.extend(f"[{lua_string(name)}]=1," for name in names)
+            lines.append("        },")
+        lines.append("    },")
+
+        return "\n".join(lines) + "\n"
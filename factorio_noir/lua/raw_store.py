@@ -0,0 +1,192 @@
+"""Indexed on-disk store of a parsed data.raw, written by raw_to_dict.py.
+
+Prototypes are pickled one by one into an SQLite database, keyed by type and
+name, so that a lookup only loads the prototypes it needs. Every file a
+prototype references is indexed too, with the path of the field holding it,
+to find which prototypes use a given sprite.
+"""
+import json
+import os
+import pickle
+import re
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+# Bump whenever the schema or the content of the store changes
+STORE_VERSION = 1
+
+# Strings naming a file of a mod, like "__base__/graphics/entity/pipe/pipe.png"
+FILE_REFERENCE = re.compile(r"__[^/]+__/.+\.[A-Za-z0-9]+")
+
+# The keys leading to a field from the root of its prototype
+FieldPath = Tuple[Any, ...]
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE prototypes (
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (type, name)
+);
+CREATE TABLE file_references (
+    filename TEXT NOT NULL,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    field_path TEXT NOT NULL
+);
+"""
+
+# Created once the data is in, it's faster than maintaining it on each insert
+INDEXES = """
+CREATE INDEX file_references_filename ON file_references (filename);
+CREATE INDEX file_references_prototype ON file_references (type, name);
+"""
+
+
+def file_references(
+    value: Any, path: FieldPath = ()
+) -> Iterator[Tuple[str, FieldPath]]:
+    """Yield every file referenced in a prototype, with the path of its field."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from file_references(item, path + (key,))
+
+    elif isinstance(value, str) and FILE_REFERENCE.fullmatch(value):
+        yield value, path
+
+
+class RawStore:
+    """Read access to a data.raw store, prototypes are only loaded on demand."""
+
+    db_path: Path
+    db: sqlite3.Connection
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        if not db_path.is_file():
+            raise FileNotFoundError(f"No data.raw store at {db_path}")
+
+        # Opened read only, nothing but raw_to_dict.py writes to it
+        self.db = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+
+        version = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'version'"
+        ).fetchone()
+        if version is None or int(version[0]) != STORE_VERSION:
+            self.db.close()
+            raise ValueError(
+                f"{db_path} was written by another version, run raw_to_dict.py again"
+            )
+
+    @classmethod
+    def create(cls, db_path: Path, raw: Dict[str, Dict[str, Any]]) -> "RawStore":
+        """Write a parsed data.raw into a new store, replacing any previous one."""
+        tmp_path = db_path.with_name(db_path.name + ".tmp")
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+        db = sqlite3.connect(str(tmp_path))
+        # Written in one go, and only renamed once complete: no journal needed
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.executescript(SCHEMA)
+
+        db.execute("INSERT INTO meta VALUES ('version', ?)", (str(STORE_VERSION),))
+        db.executemany(
+            "INSERT INTO prototypes VALUES (?, ?, ?)",
+            (
+                (prototype_type, name, pickle.dumps(prototype, pickle.HIGHEST_PROTOCOL))
+                for prototype_type, prototypes in raw.items()
+                for name, prototype in prototypes.items()
+            ),
+        )
+        db.executemany(
+            "INSERT INTO file_references VALUES (?, ?, ?, ?)",
+            (
+                (filename, prototype_type, name, json.dumps(field_path))
+                for prototype_type, prototypes in raw.items()
+                for name, prototype in prototypes.items()
+                for filename, field_path in file_references(prototype)
+            ),
+        )
+        db.executescript(INDEXES)
+        db.commit()
+        db.close()
+
+        os.replace(tmp_path, db_path)
+        return cls(db_path)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self) -> "RawStore":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def types(self) -> List[str]:
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT DISTINCT type FROM prototypes ORDER BY 1"
+            )
+        ]
+
+    def names(self, prototype_type: str) -> List[str]:
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT name FROM prototypes WHERE type = ? ORDER BY 1",
+                (prototype_type,),
+            )
+        ]
+
+    def prototype(self, prototype_type: str, name: str) -> Optional[Dict[str, Any]]:
+        row = self.db.execute(
+            "SELECT data FROM prototypes WHERE type = ? AND name = ?",
+            (prototype_type, name),
+        ).fetchone()
+
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def prototypes(
+        self, prototype_type: Optional[str] = None
+    ) -> Iterator[Tuple[str, str, Dict[str, Any]]]:
+        """Iterate over the prototypes, of a single type if given."""
+        query = "SELECT type, name, data FROM prototypes"
+        parameters: Tuple[str, ...] = ()
+        if prototype_type is not None:
+            query += " WHERE type = ?"
+            parameters = (prototype_type,)
+
+        for row_type, name, data in self.db.execute(query, parameters):
+            yield row_type, name, pickle.loads(data)
+
+    def referencing(self, filename: str) -> List[Tuple[str, str, FieldPath]]:
+        """The prototypes referencing a file, with the path of each field."""
+        return [
+            (prototype_type, name, tuple(json.loads(field_path)))
+            for prototype_type, name, field_path in self.db.execute(
+                "SELECT type, name, field_path FROM file_references WHERE filename = ?",
+                (filename,),
+            )
+        ]
+
+    def references(self) -> Iterator[Tuple[str, str, str, FieldPath]]:
+        """Every file reference: filename, prototype type and name, field path."""
+        for filename, prototype_type, name, field_path in self.db.execute(
+            "SELECT filename, type, name, field_path FROM file_references"
+        ):
+            yield filename, prototype_type, name, tuple(json.loads(field_path))
+
+    def filenames(self) -> Set[str]:
+        """All the files referenced by at least one prototype."""
+        return {
+            row[0]
+            for row in self.db.execute("SELECT DISTINCT filename FROM file_references")
+        }
@@ -5,11 +5,15 @@
 import math
 import pickle
 import operator
+from pathlib import Path
 
+import click
 import luaparser.ast
 import luaparser.astnodes as lua
 from luaparser.utils.visitor import visitor
 
+from factorio_noir.lua import serpent
+from factorio_noir.lua.raw_store import RawStore
 
 UNARY_OP_TABLE = {
     lua.UMinusOp: operator.neg,
@@ -35,6 +39,9 @@ class LuaDictVisitor:
 
     @visitor(lua.String)
     def visit(self, node):
+        # Newer luaparser versions give the unescaped bytes
+        if isinstance(node.s, bytes):
+            return node.s.decode("utf-8", errors="replace")
         return node.s
 
     @visitor(lua.Number)
@@ -62,22 +69,49 @@ class LuaDictVisitor:
     @visitor(lua.Table)
     def visit(self, node):
         table = {}
+        index = 1
         for field in node.fields:
-            table[self.visit(field.key)] = self.visit(field.value)
+            if field.key is None:
+                # Newer luaparser versions don't number array items
+                table[float(index)] = self.visit(field.value)
+                index += 1
+            else:
+                table[self.visit(field.key)] = self.visit(field.value)
         return table
 
 
-if __name__ == "__main__":
-    print("Parsing raw.txt, this will take a while")
-    with open("raw.txt") as f:
-        root = luaparser.ast.parse(f.read())
+def luaparser_load(raw_path: Path):
+    """The generic, much slower, way: build the whole AST then walk it."""
+    root = luaparser.ast.parse(raw_path.read_text())
 
     # raw = { ... parses as
     # Chunk.body -> Block.body -> list[0] -> Assign.values -> list[0] -> Table
-    print("converting to dict")
     table = root.body.body[0].values[0]
-    converted = LuaDictVisitor().visit(table)
+    return LuaDictVisitor().visit(table)
+
+
+@click.command()
+@click.argument("raw-txt", default="raw.txt", type=click.Path(exists=True))
+@click.argument("output", default="raw.sqlite", type=click.Path())
+@click.option("--luaparser", "use_luaparser", is_flag=True, help="Parse with luaparser")
+def main(raw_txt, output, use_luaparser):
+    """Convert a data.raw dump into an indexed store, see raw_store.py.
+
+    An OUTPUT ending in .pickle gets the whole data.raw pickled instead.
+    """
+    print(f"Parsing {raw_txt}")
+    if use_luaparser:
+        converted = luaparser_load(Path(raw_txt))
+    else:
+        converted = serpent.load(Path(raw_txt))
 
-    print("writing to raw.pickle")
-    with open("raw.pickle", "wb") as output:
-        pickle.dump(converted, output)
+    print(f"writing to {output}")
+    if output.endswith(".pickle"):
+        with open(output, "wb") as output_file:
+            pickle.dump(converted, output_file)
+    else:
+        RawStore.create(Path(output), converted).close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""Parse serpent dumps of Lua tables, like data.raw, straight into Python.
+
+Only what serpent outputs is supported: nested table constructors of
+strings, numbers, booleans and nil, with comments. Values come out the same
+as through raw_to_dict.LuaDictVisitor: numbers are floats, including the
+implicit keys of array items, and infinity, which serpent writes as a
+division by zero, is math.inf. lua_string and lua_value go the other way,
+for the Lua generated by the build.
+"""
+import gc
+import math
+import mmap
+import operator
+import re
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+_SKIP = rb"\s*(?:--(?:\[(?P<comment_level>=*)\[.*?\](?P=comment_level)\]|[^\n]*)\s*)*"
+_NUMBER = rb"0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?"
+_STRING = rb"""\"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'"""
+
+# Whitespace and comments, then a single token
+_TOKEN = re.compile(
+    _SKIP
+    + rb"""(?:
+        (?P<name>[A-Za-z_]\w*)
+      | (?P<number>"""
+    + _NUMBER
+    + rb""")
+      | (?P<string>"""
+    + _STRING
+    + rb""")
+      | (?P<long_string>\[(?P<level>=*)\[.*?\](?P=level)\])
+      | (?P<symbol>[{}\[\]=,;/~-])
+      | (?P<end>\Z)
+    )""",
+    re.DOTALL | re.VERBOSE,
+)
+
+# Fast path for what most of a dump is made of, a whole table field: its
+# optional key, then a plain value with its separator, or the start of a
+# nested table. A table end matches too, and anything else only matches the
+# key, leaving the value to the generic tokenizer.
+_FIELD = re.compile(
+    _SKIP
+    + rb"(?:(?:(?P<key_name>[A-Za-z_]\w*)|\[\s*(?:(?P<key_string>"
+    + _STRING
+    + rb")|(?P<key_number>"
+    + _NUMBER
+    + rb"))\s*\])\s*=(?!=)\s*)?"
+    + rb"(?:(?:(?P<string>"
+    + _STRING
+    + rb")|(?P<number>-?(?:"
+    + _NUMBER
+    + rb"))|(?P<named>true|false|nil)\b)\s*(?P<separator>[,;}])"
+    + rb"|(?P<open>\{)|(?P<close>\}))?",
+    re.DOTALL,
+)
+_SEPARATOR = re.compile(_SKIP + rb"(?P<separator>[,;}])", re.DOTALL)
+
+_ESCAPE = re.compile(
+    rb"\\(?:(?P<digits>\d{1,3})|x(?P<hex>[0-9a-fA-F]{2})|u\{(?P<code>[0-9a-fA-F]+)\}"
+    rb"|z\s*|(?P<char>.))",
+    re.DOTALL,
+)
+
+_ESCAPED_CHARS = {
+    b"a": b"\a",
+    b"b": b"\b",
+    b"f": b"\f",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"v": b"\v",
+    b"\n": b"\n",
+    b"\\": b"\\",
+    b'"': b'"',
+    b"'": b"'",
+}
+
+UNARY_OPS: Dict[bytes, Callable[[Any], Any]] = {
+    b"-": operator.neg,
+    b"~": operator.inv,
+    b"not": operator.not_,
+}
+
+NAMED_VALUES = {b"true": True, b"false": False, b"nil": None}
+
+Token = Tuple[str, bytes]
+
+
+class SerpentError(ValueError):
+    """The dump is not a table constructor serpent could have written."""
+
+
+def _unescape(match: "re.Match[bytes]") -> bytes:
+    if match.group("digits") is not None:
+        return bytes([int(match.group("digits"))])
+
+    if match.group("hex") is not None:
+        return bytes([int(match.group("hex"), 16)])
+
+    if match.group("code") is not None:
+        return chr(int(match.group("code"), 16)).encode("utf-8")
+
+    if match.group("char") is None:
+        # \z skips the following whitespace
+        return b""
+
+    return _ESCAPED_CHARS.get(match.group("char"), match.group(0))
+
+
+def _decode_string(token: bytes) -> str:
+    raw = token[1:-1]
+    if b"\\" in raw:
+        raw = _ESCAPE.sub(_unescape, raw)
+    return raw.decode("utf-8", errors="replace")
+
+
+def _decode_long_string(token: bytes) -> str:
+    level = token.index(b"[", 1) + 1
+    raw = token[level:-level]
+    # Like Lua, drop the newline right after the opening bracket
+    if raw.startswith(b"\n"):
+        raw = raw[1:]
+    return raw.decode("utf-8", errors="replace")
+
+
+def _decode_number(token: bytes) -> float:
+    if b"x" in token or b"X" in token:
+        return float(int(token, 16))
+    return float(token)
+
+
+class Parser:
+    """Single pass recursive descent parser, building the values directly."""
+
+    def __init__(self, data: Union[bytes, mmap.mmap]):
+        self.data = data
+        self.pos = 0
+        self.lookahead: Optional[Token] = None
+        self.lookahead_pos = 0
+
+    def next(self) -> Token:
+        if self.lookahead is not None:
+            token, self.lookahead = self.lookahead, None
+            return token
+
+        match = _TOKEN.match(self.data, self.pos)
+        if match is None:
+            raise SerpentError(f"Unexpected character at offset {self.pos}")
+
+        self.pos = match.end()
+        kind = match.lastgroup
+        assert kind is not None
+        return kind, match.group(kind)
+
+    def peek(self) -> Token:
+        if self.lookahead is None:
+            start = self.pos
+            self.lookahead = self.next()
+            self.lookahead_pos = start
+        return self.lookahead
+
+    def rewind(self) -> None:
+        """Give back the peeked token, before matching the fast path patterns."""
+        if self.lookahead is not None:
+            self.pos = self.lookahead_pos
+            self.lookahead = None
+
+    def expect(self, symbol: bytes) -> None:
+        kind, text = self.next()
+        if text != symbol:
+            raise SerpentError(
+                f"Expected {symbol.decode()!r} before offset {self.pos}, "
+                f"got {text.decode(errors='replace')!r}"
+            )
+
+    def chunk(self) -> Any:
+        """Parse a whole dump: a table, optionally returned or assigned to a name."""
+        kind, text = self.next()
+        if text == b"return":
+            kind, text = self.next()
+        elif kind == "name" and self.peek() == ("symbol", b"="):
+            self.next()
+            kind, text = self.next()
+
+        value = self.value(kind, text)
+        if self.next()[0] != "end":
+            raise SerpentError(f"Trailing data before offset {self.pos}")
+        return value
+
+    def value(self, kind: str, text: bytes) -> Any:
+        value = self.operand(kind, text)
+
+        # Serpent writes math.huge as 1/0, -math.huge as -1/0 and nan as 0/0
+        while self.peek() == ("symbol", b"/"):
+            self.next()
+            divisor = self.operand(*self.next())
+            if divisor == 0.0:
+                value = value * math.inf
+            else:
+                value = value / divisor
+
+        return value
+
+    def operand(self, kind: str, text: bytes) -> Any:
+        if kind == "string":
+            return _decode_string(text)
+
+        if kind == "number":
+            return _decode_number(text)
+
+        if text == b"{":
+            return self.table()
+
+        if text in UNARY_OPS:
+            # Unary operators bind tighter than the division
+            return UNARY_OPS[text](self.operand(*self.next()))
+
+        if kind == "name":
+            if text in NAMED_VALUES:
+                return NAMED_VALUES[text]
+            return text.decode("utf-8")
+
+        if kind == "long_string":
+            return _decode_long_string(text)
+
+        raise SerpentError(
+            f"Unexpected {text.decode(errors='replace')!r} before offset {self.pos}"
+        )
+
+    def separator(self) -> bytes:
+        """Read the separator after a table field."""
+        self.rewind()
+        match = _SEPARATOR.match(self.data, self.pos)
+        if match is None:
+            raise SerpentError(f"Expected ',' or '}}' at offset {self.pos}")
+
+        self.pos = match.end()
+        return match.group("separator")
+
+    def table(self) -> Dict[Any, Any]:
+        table: Dict[Any, Any] = {}
+        index = 1
+
+        self.rewind()
+        while True:
+            match = _FIELD.match(self.data, self.pos)
+            assert match is not None
+            (
+                _,
+                key_name,
+                key_string,
+                key_number,
+                string,
+                number,
+                named,
+                separator,
+                table_open,
+                table_close,
+            ) = match.groups()
+            self.pos = match.end()
+
+            if key_name is not None:
+                key = key_name.decode("utf-8")
+            elif key_string is not None:
+                key = _decode_string(key_string)
+            elif key_number is not None:
+                key = _decode_number(key_number)
+            elif table_close is not None:
+                return table
+            else:
+                key = None
+
+            if key is not None and table_close is not None:
+                raise SerpentError(f"Missing value before offset {self.pos}")
+
+            if separator is not None:
+                if string is not None:
+                    value = _decode_string(string)
+                elif number is not None:
+                    value = _decode_number(number)
+                else:
+                    value = NAMED_VALUES[named]
+
+            else:
+                if table_open is not None:
+                    value = self.table()
+                else:
+                    kind, text = self.next()
+                    if key is None and kind == "symbol" and text == b"[":
+                        # A key that is not a plain string or number, like [true]
+                        key = self.value(*self.next())
+                        self.expect(b"]")
+                        self.expect(b"=")
+                        kind, text = self.next()
+
+                    value = self.value(kind, text)
+
+                separator = self.separator()
+
+            if key is None:
+                key = float(index)
+                index += 1
+
+            table[key] = value
+            if separator == b"}":
+                return table
+
+
+def parse(data: Union[bytes, mmap.mmap]) -> Any:
+    # Millions of new dicts would trigger the garbage collector over and over,
+    # while none of them can be part of a reference cycle.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return Parser(data).chunk()
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Parse a serpent dump held in memory."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return parse(data)
+
+
+def load(path: Path) -> Any:
+    """Parse a serpent dump file, mapped rather than read into memory."""
+    with path.open("rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse(data)
+
+
+def lua_string(value: str) -> str:
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def lua_value(value: Any) -> str:
+    """A string or number as a Lua literal, array indexes are integers in Lua."""
+    if isinstance(value, str):
+        return lua_string(value)
+
+    if isinstance(value, bool):
+        return "true" if value else "false"
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return repr(value)
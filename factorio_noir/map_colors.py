@@ -0,0 +1,176 @@
+"""Desaturate the map colors of data.raw, for packs/Vanilla/desaturate_map.lua.
+
+The color matrices come from render.ColorSpace, like the sprites, and are
+written to config.lua for the Lua side. Given a data.raw store, the colors
+are also desaturated here once and for all, so that the game only assigns
+them at load.
+"""
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from factorio_noir.category import DEFAULT_COLOR_SPACE
+from factorio_noir.lua.raw_store import FieldPath, RawStore
+from factorio_noir.lua.serpent import lua_string, lua_value
+from factorio_noir.render import ColorSpace
+
+# Brightness and saturation of each kind of color
+DESATURATIONS = {
+    "map": (0.7, 0.1),
+    "water": (0.5, 0.6),
+    "water_secondary": (0.5, 0.3),
+}
+
+# The prototype fields holding colors, and how they are desaturated
+PROTOTYPE_FIELDS = {
+    "map_color": "map",
+    "friendly_map_color": "map",
+    "enemy_map_color": "map",
+    "effect_color": "water",
+    "effect_color_secondary": "water_secondary",
+    "foam_color": "water",
+}
+
+Color = Dict[str, float]
+
+# A prototype, the path of one of its fields, and the color to set it to
+ColorPatch = Tuple[str, str, FieldPath, Color]
+
+
+def color_matrix(desaturation: str) -> List[float]:
+    """The 3x3 matrix of a kind of color, row by row."""
+    brightness, saturation = DESATURATIONS[desaturation]
+    matrix = ColorSpace(*DEFAULT_COLOR_SPACE).matrix(saturation, brightness, 0)
+    # Drop the offsets of Pillow's 3x4 matrix
+    return [c for i, c in enumerate(matrix) if i % 4 != 3]
+
+
+def _first(*values: Any) -> Any:
+    """Like Lua's `a or b`, where 0 is true."""
+    for value in values:
+        if value is not None and value is not False:
+            return value
+    return None
+
+
+def desaturate(color: Any, desaturation: str) -> Optional[Color]:
+    """Desaturate a Factorio color, the same way as desaturate_map.lua."""
+    if not isinstance(color, dict):
+        return None
+
+    # Colors can be either named or indexed
+    r = _first(color.get("r"), color.get(1.0), 0)
+    g = _first(color.get("g"), color.get(2.0), 0)
+    b = _first(color.get("b"), color.get(3.0), 0)
+    a = _first(color.get("a"), color.get(4.0))
+
+    # They can also be valued [0-1] or [0-255]
+    if r > 1 or g > 1 or b > 1 or _first(a, 1) > 1:
+        r, g, b = r / 255, g / 255, b / 255
+        if a is not None:
+            a = a / 255
+
+    m = color_matrix(desaturation)
+    result = {
+        "r": m[0] * r + m[1] * g + m[2] * b,
+        "g": m[3] * r + m[4] * g + m[5] * b,
+        "b": m[6] * r + m[7] * g + m[8] * b,
+    }
+
+    # Brightened past 1, Factorio would take it for a [0-255] color
+    brightest = max(result.values())
+    if brightest > 1:
+        result = {channel: value / brightest for channel, value in result.items()}
+
+    if a is not None:
+        result["a"] = a
+    return result
+
+
+def _table_patches(
+    prototype_type: str,
+    name: str,
+    path: FieldPath,
+    table: Any,
+    suffix: str = "",
+) -> Iterator[ColorPatch]:
+    if not isinstance(table, dict):
+        return
+
+    for key, color in table.items():
+        if isinstance(key, str) and key.endswith(suffix):
+            desaturated = desaturate(color, "map")
+            if desaturated is not None:
+                yield prototype_type, name, path + (key,), desaturated
+
+
+def color_patches(store: RawStore) -> List[ColorPatch]:
+    """Every color desaturate_map.lua changes in the prototypes of a store."""
+    patches: List[ColorPatch] = []
+
+    for prototype_type, name, prototype in store.prototypes():
+        for field, desaturation in PROTOTYPE_FIELDS.items():
+            desaturated = desaturate(prototype.get(field), desaturation)
+            if desaturated is not None:
+                patches.append((prototype_type, name, (field,), desaturated))
+
+        if prototype_type == "utility-constants" and name == "default":
+            # The default colors of the map
+            chart = prototype.get("chart", {})
+            patches.extend(
+                _table_patches(prototype_type, name, ("chart",), chart, "_color")
+            )
+            for by_type in ("default_color_by_type", "default_friendly_color_by_type"):
+                patches.extend(
+                    _table_patches(
+                        prototype_type, name, ("chart", by_type), chart.get(by_type)
+                    )
+                )
+
+        if prototype_type == "character" and name == "character":
+            # The entire screen flashes this color on damage being taken
+            desaturated = desaturate(prototype.get("damage_hit_tint"), "water")
+            if desaturated is not None:
+                patches.append(
+                    (prototype_type, name, ("damage_hit_tint",), desaturated)
+                )
+
+    return patches
+
+
+def lua_color(color: Color) -> str:
+    return "{" + ", ".join(f"{key} = {value!r}" for key, value in color.items()) + "}"
+
+
+def lua_config(patches: Optional[List[ColorPatch]]) -> str:
+    """The map_colors field of config.lua, read by desaturate_map.lua."""
+    lines = ["    map_colors = {", "        matrices = {"]
+    for desaturation in DESATURATIONS:
+        matrix = ", ".join(repr(c) for c in color_matrix(desaturation))
+        lines.append(f"            {desaturation} = {{{matrix}}},")
+    lines.append("        },")
+
+    lines.append("        fields = {")
+    for field, desaturation in PROTOTYPE_FIELDS.items():
+        lines.append(f"            {field} = {lua_string(desaturation)},")
+    lines.append("        },")
+
+    # Without a dump, every color is desaturated at load
+    if patches is not None:
+        by_prototype: Dict[str, Dict[str, List[str]]] = {}
+        for prototype_type, name, field_path, color in patches:
+            fields = ", ".join(lua_value(field) for field in field_path)
+            by_prototype.setdefault(prototype_type, {}).setdefault(name, []).append(
+                f"{{{fields}, {lua_color(color)}}}"
+            )
+
+        lines.append("        precomputed = {")
+        for prototype_type, prototypes in sorted(by_prototype.items()):
+            lines.append(f"            [{lua_string(prototype_type)}] = {{")
+            for name, entries in sorted(prototypes.items()):
+                lines.append(f"                [{lua_string(name)}] = {{")
+                lines.extend(f"                    {entry}," for entry in entries)
+                lines.append("                },")
+            lines.append("            },")
+        lines.append("        },")
+
+    lines.append("    },")
+    return "\n".join(lines) + "\n"
@@ -1,8 +1,58 @@
+from collections import OrderedDict
 from dataclasses import dataclass
 from fnmatch import fnmatch
+import hashlib
+import io
+import json
+import mmap
+import os
 from pathlib import Path
-from typing import IO, Iterable, List, Optional, Tuple, Set, Dict
+import re
+import struct
+import threading
+from typing import IO, Any, Iterable, List, Optional, Tuple, Set, Dict, Union
 import zipfile
+import zlib
+
+import click
+
+from factorio_noir.timing import timed
+
+# How many zipped mods each process keeps open at the same time
+MAX_OPEN_ARCHIVES = 16
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Signature, then the IHDR chunk: length, type, and 13 bytes of data
+PNG_HEADER_SIZE = 8 + 8 + 13
+
+
+@dataclass(eq=True, frozen=True)
+class PngHeader:
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return (self.width, self.height)
+
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+
+def parse_png_header(data: bytes) -> PngHeader:
+    """Read the image metadata from the first bytes of a PNG file."""
+    if len(data) < PNG_HEADER_SIZE or data[:8] != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+
+    chunk_type = data[12:16]
+    if chunk_type != b"IHDR":
+        raise ValueError(f"PNG file starting with a {chunk_type!r} chunk")
+
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", data[16:26])
+    return PngHeader(width, height, bit_depth, color_type)
 
 
 @dataclass(eq=True, frozen=True)
@@ -17,91 +67,660 @@ class LazyFile:
             return (self.mod_path / self.file_path).open("rb")
 
         elif self.mod_type == "zip":
-            with zipfile.ZipFile(str(self.mod_path), "r") as zfile:
-                return zfile.open(self.file_path, "r")
+            return MemoryReader(self.read())
 
         else:
             raise Exception(f"Unknown mod_type: {self.mod_type}")
 
+    def read(self) -> Union[bytes, memoryview]:
+        """Read the whole file, stored zip entries are returned without a copy."""
+        if self.mod_type == "file":
+            return (self.mod_path / self.file_path).read_bytes()
+
+        elif self.mod_type == "zip":
+            return zip_reader(self.mod_path).read(self.file_path)
+
+        else:
+            raise Exception(f"Unknown mod_type: {self.mod_type}")
+
+    def head(self, length: int) -> bytes:
+        """Read only the first bytes of the file."""
+        if self.mod_type == "file":
+            with (self.mod_path / self.file_path).open("rb") as f:
+                return f.read(length)
+
+        elif self.mod_type == "zip":
+            return zip_reader(self.mod_path).read_head(self.file_path, length)
+
+        else:
+            raise Exception(f"Unknown mod_type: {self.mod_type}")
+
+    def png_header(self) -> PngHeader:
+        try:
+            return parse_png_header(self.head(PNG_HEADER_SIZE))
+        except ValueError as e:
+            raise ValueError(f"{self.mod_path}: {self.file_path}: {e}") from None
+
+    def size(self) -> int:
+        """Size of the file in bytes, without reading it."""
+        if self.mod_type == "file":
+            return (self.mod_path / self.file_path).stat().st_size
+
+        elif self.mod_type == "zip":
+            return zip_crcs(self.mod_path)[self.file_path][1]
+
+        else:
+            raise Exception(f"Unknown mod_type: {self.mod_type}")
+
+    def fingerprint(self) -> str:
+        """Identify the content of the file, without reading it if possible."""
+        if self.mod_type == "file":
+            full_path = self.mod_path / self.file_path
+            stamp = _stamp(full_path)
+
+            # Files are only hashed again once modified, for --watch rebuilds
+            if full_path in _file_fingerprints:
+                known_stamp, fingerprint = _file_fingerprints[full_path]
+                if known_stamp == stamp:
+                    return fingerprint
+
+            # And across builds, through the mod index
+            index = mod_index(self.mod_path.parent)
+            indexed = None
+            if index is not None:
+                indexed = index.fingerprint(self.mod_path, self.file_path, stamp)
+
+            if indexed is not None:
+                fingerprint = indexed
+            else:
+                with full_path.open("rb") as f:
+                    fingerprint = "sha1:" + hashlib.sha1(f.read()).hexdigest()
+
+                if index is not None:
+                    index.store_fingerprint(
+                        self.mod_path, self.file_path, stamp, fingerprint
+                    )
+
+            _file_fingerprints[full_path] = (stamp, fingerprint)
+            return fingerprint
+
+        elif self.mod_type == "zip":
+            crc, size = zip_crcs(self.mod_path)[self.file_path]
+            return f"crc32:{crc:08x}:{size}"
+
+        else:
+            raise Exception(f"Unknown mod_type: {self.mod_type}")
+
+
+class MemoryReader(io.RawIOBase):
+    """A read-only file over bytes or a memoryview, without copying them.
+
+    io.BytesIO copies a memoryview it is given, this only copies the parts
+    that are read.
+    """
+
+    def __init__(self, data: Union[bytes, memoryview]):
+        self._data = memoryview(data)
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        chunk = self._data[self._position : self._position + len(buffer)]
+        buffer[: len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._data)
+
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        # Let the mmap be closed once nothing reads it anymore
+        self._data.release()
+        super().close()
+
+
+class ZipReader:
+    """A zipped mod kept open and memory-mapped, to serve many reads."""
 
-class Mod:
     mod_path: Path
-    all_files: Set[str]
-    name: str
-    file_prefix: str
-    mod_type: str
+    zfile: zipfile.ZipFile
 
-    def __init__(self, mod_name: str, mod_path: Path):
+    def __init__(self, mod_path: Path):
         self.mod_path = mod_path
+        self._file = open(mod_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The central directory is only parsed once, here
+        self.zfile = zipfile.ZipFile(self._file, "r")
+
+    def _raw_data(self, info: zipfile.ZipInfo) -> memoryview:
+        """The data of a stored or deflated entry, as it is in the archive."""
+        # The data starts right after the local header, whose extra field
+        # may differ from the one in the central directory.
+        header = self._mmap[info.header_offset : info.header_offset + 30]
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        start = info.header_offset + 30 + name_length + extra_length
+
+        return memoryview(self._mmap)[start : start + info.compress_size]
+
+    def read(self, file_path: str) -> Union[bytes, memoryview]:
+        info = self.zfile.getinfo(file_path)
+
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return self.zfile.read(info)
+
+        data = self._raw_data(info)
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS, info.file_size)
+
+        # ZipFile.read checks it too, hashing doesn't copy the data
+        if zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {file_path!r}")
+
+        return data
+
+    def read_head(self, file_path: str, length: int) -> bytes:
+        """Read the first bytes of a file, only inflating what is needed."""
+        info = self.zfile.getinfo(file_path)
+
+        if info.compress_type == zipfile.ZIP_STORED:
+            return bytes(self._raw_data(info)[:length])
+
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+                self._raw_data(info), length
+            )
+
+        with self.zfile.open(info) as f:
+            return f.read(length)
+
+    def close(self) -> None:
+        self.zfile.close()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Some memoryview is still in use, the map is released with it
+            pass
+        self._file.close()
+
+
+_zip_readers: "OrderedDict[Path, ZipReader]" = OrderedDict()
+_zip_readers_pid = os.getpid()
+_zip_readers_lock = threading.Lock()
+
+
+def zip_reader(mod_path: Path) -> ZipReader:
+    """Get the open reader of a zipped mod, from a per process LRU pool."""
+    global _zip_readers, _zip_readers_pid
+
+    with _zip_readers_lock:
+        if _zip_readers_pid != os.getpid():
+            # Forked from the parent: its handles share file offsets with us
+            _zip_readers, _zip_readers_pid = OrderedDict(), os.getpid()
+
+        if mod_path in _zip_readers:
+            _zip_readers.move_to_end(mod_path)
+            return _zip_readers[mod_path]
 
-        print(f"Loading: {mod_name} -> {mod_path}")
+    # Parsing the central directory is slow, let other archives open meanwhile
+    reader = ZipReader(mod_path)
 
-        if self.mod_path.is_dir():
-            # File baised mod
-            full_mod_name = self.mod_path.name
-            self.file_prefix = ""
-            self.mod_type = "file"
-            self.all_files = {
-                str(p.relative_to(self.mod_path).as_posix())
-                for p in self.mod_path.glob("**/*.png")
+    with _zip_readers_lock:
+        if mod_path in _zip_readers:
+            # Another thread opened it first
+            reader.close()
+            return _zip_readers[mod_path]
+
+        _zip_readers[mod_path] = reader
+
+        while len(_zip_readers) > MAX_OPEN_ARCHIVES:
+            _, idle_reader = _zip_readers.popitem(last=False)
+            idle_reader.close()
+
+        return reader
+
+
+# Fingerprint of plain files, with the mtime and size they were computed for
+_file_fingerprints: Dict[Path, Tuple[List[int], str]] = {}
+
+# CRC and size of the files of each zipped mod, prefilled from the mod index
+_zip_crcs: Dict[Path, Dict[str, Tuple[int, int]]] = {}
+
+
+def zip_crcs(mod_path: Path) -> Dict[str, Tuple[int, int]]:
+    """Read the CRC and size of every file in a zipped mod."""
+    if mod_path not in _zip_crcs:
+        _zip_crcs[mod_path] = {
+            info.filename: (info.CRC, info.file_size)
+            for info in zip_reader(mod_path).zfile.infolist()
+        }
+
+    return _zip_crcs[mod_path]
+
+
+# Bump whenever the content of the mod index files changes
+MOD_INDEX_VERSION = 2
+
+
+def _stamp(path: Path) -> List[int]:
+    """What invalidates an index entry: the file's mtime and size."""
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class ModIndex:
+    """On-disk index of the mods found in one source directory.
+
+    It remembers the directory listing, which mod name resolves to which
+    path, the PNG files of each mod, and the fingerprints of the files of
+    unpacked mods. Entries are only used while the
+    path, mtime and size they were built from are unchanged, so a warm start
+    doesn't walk the filesystem or read any zip.
+    """
+
+    source_dir: Path
+    path: Path
+
+    def __init__(self, index_dir: Path, source_dir: Path):
+        self.source_dir = source_dir
+        self.path = (
+            index_dir
+            / f"{hashlib.sha1(str(source_dir.resolve()).encode()).hexdigest()}.json"
+        )
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        data: Dict[str, Any] = {}
+        try:
+            with self.path.open() as index_file:
+                data = json.load(index_file)
+        except (OSError, ValueError):
+            pass
+
+        if (
+            data.get("version") != MOD_INDEX_VERSION
+            or data.get("source_dir") != str(source_dir)
+        ):
+            data = {}
+
+        self._listing: Optional[Dict[str, Any]] = data.get("listing")
+        self._mods: Dict[str, Dict[str, Any]] = data.get("mods", {})
+        # mod path -> file path -> [mtime, size, fingerprint]
+        self._fingerprints: Dict[str, Dict[str, List[Any]]] = data.get(
+            "fingerprints", {}
+        )
+
+    def resolve(self, mod_name: str) -> Optional[Path]:
+        """Find the newest version of a mod in this source directory."""
+        stamp = _stamp(self.source_dir)
+
+        with self._lock:
+            if self._listing is None or self._listing["stamp"] != stamp:
+                self._listing = {
+                    "stamp": stamp,
+                    "entries": [f.name for f in self.source_dir.iterdir()],
+                    "resolved": {},
+                }
+                self._dirty = True
+
+            resolved = self._listing["resolved"]
+            if mod_name not in resolved:
+                resolved[mod_name] = find_mod_entry(mod_name, self._listing["entries"])
+                self._dirty = True
+
+            if resolved[mod_name] is None:
+                return None
+
+            return self.source_dir / resolved[mod_name]
+
+    def mod_stamp(self, mod_path: Path) -> List[Optional[int]]:
+        stamp: List[Optional[int]] = list(_stamp(mod_path))
+
+        if mod_path.is_dir():
+            # A directory's own mtime only changes with its direct children,
+            # info.json also changes when Factorio gets updated
+            info_path = mod_path / "info.json"
+            if info_path.is_file():
+                stamp.extend(_stamp(info_path))
+            else:
+                # Not all unpacked mods have one
+                stamp.extend([None, None])
+
+        return stamp
+
+    def files(self, mod_path: Path) -> Optional[Dict[str, Any]]:
+        """The indexed content of a mod, if still valid."""
+        with self._lock:
+            entry = self._mods.get(str(mod_path))
+
+        if entry is None or entry["stamp"] != self.mod_stamp(mod_path):
+            return None
+
+        # Adding or removing a file changes the mtime of its directory, a
+        # stat of each directory is much cheaper than listing them all again
+        for directory, mtime in entry.get("directories", {}).items():
+            try:
+                if (mod_path / directory).stat().st_mtime_ns != mtime:
+                    return None
+            except OSError:
+                return None
+
+        return entry
+
+    def store(
+        self,
+        mod_path: Path,
+        file_prefix: str,
+        files: Any,
+        directories: Optional[Dict[str, int]] = None,
+    ) -> None:
+        entry = {
+            "stamp": self.mod_stamp(mod_path),
+            "prefix": file_prefix,
+            "files": files,
+        }
+        if directories is not None:
+            entry["directories"] = directories
+
+        with self._lock:
+            self._mods[str(mod_path)] = entry
+            if isinstance(files, list):
+                # Forget the fingerprints of the files that are gone
+                listed = set(files)
+                fingerprints = self._fingerprints.get(str(mod_path), {})
+                self._fingerprints[str(mod_path)] = {
+                    file_path: known
+                    for file_path, known in fingerprints.items()
+                    if file_path in listed
+                }
+            self._dirty = True
+
+    def fingerprint(
+        self, mod_path: Path, file_path: str, stamp: List[int]
+    ) -> Optional[str]:
+        """The fingerprint of a file of an unpacked mod, if still valid."""
+        with self._lock:
+            known = self._fingerprints.get(str(mod_path), {}).get(file_path)
+
+        if known is None or known[:2] != stamp:
+            return None
+
+        return known[2]
+
+    def store_fingerprint(
+        self, mod_path: Path, file_path: str, stamp: List[int], fingerprint: str
+    ) -> None:
+        with self._lock:
+            fingerprints = self._fingerprints.setdefault(str(mod_path), {})
+            fingerprints[file_path] = stamp + [fingerprint]
+            self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+
+            data = {
+                "version": MOD_INDEX_VERSION,
+                "source_dir": str(self.source_dir),
+                "listing": self._listing,
+                "mods": self._mods,
+                # Copied, the build may still add fingerprints meanwhile
+                "fingerprints": {
+                    mod_path: dict(fingerprints)
+                    for mod_path, fingerprints in self._fingerprints.items()
+                },
             }
+            self._dirty = False
+
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp_path.open("w") as index_file:
+            json.dump(data, index_file)
+        os.replace(tmp_path, self.path)
 
-        else:
-            # Zipped baised mod
-            full_mod_name = self.mod_path.stem
-            self.mod_type = "zip"
 
-            zfile = zipfile.ZipFile(str(self.mod_path), "r")
+_mod_index_dir: Optional[Path] = None
+_mod_indexes: Dict[Path, ModIndex] = {}
+_mod_indexes_lock = threading.Lock()
 
-            # There should be exactly 1x folder withing the root of the mod
-            self.file_prefix = zfile.namelist()[0].split("/")[0] + "/"
 
-            self.all_files = set()
+def use_mod_index(index_dir: Optional[Path]) -> None:
+    """Keep the mod indexes in the given directory, None to disable them."""
+    global _mod_index_dir
+    _mod_index_dir = index_dir
 
-            for f in zfile.namelist():
-                f = str(f)
 
-                assert f.startswith(self.file_prefix), (
-                    f"Mod {mod_name} has file '{f}' with invalid name"
-                    f" (Not starting with '{self.file_prefix}')"
-                )
+def mod_index(source_dir: Path) -> Optional[ModIndex]:
+    if _mod_index_dir is None:
+        return None
 
-                if not f.endswith("png"):
-                    continue
+    with _mod_indexes_lock:
+        if source_dir not in _mod_indexes:
+            _mod_indexes[source_dir] = ModIndex(_mod_index_dir, source_dir)
 
-                self.all_files.add(f[len(self.file_prefix) :])
+        return _mod_indexes[source_dir]
 
-        self.name = mod_name
 
-    def files(self, filter: Path) -> Iterable[str]:
-        for f in self.all_files:
-            filter_s = filter.parts
+def save_mod_indexes() -> None:
+    with _mod_indexes_lock:
+        indexes = list(_mod_indexes.values())
+
+    for index in indexes:
+        index.save()
+
+
+def filter_check(current_path: List[str], current_filter: Tuple[str, ...]) -> bool:
+    """Check a single path against a glob, segment by segment.
+
+    This is the reference implementation PathTrie.glob must agree with.
+    """
+    if len(current_filter) == 0 and len(current_path) == 0:
+        return True
+
+    if len(current_filter) == 0 or len(current_path) == 0:
+        return False
+
+    if current_filter[0] == "**":
+        # recursivly absorb path members
+        # This could get very slow with multiple '**'s
+        for i in range(len(current_path)):
+            if filter_check(current_path[i:], current_filter[1:]):
+                return True
+        return False
+
+    elif fnmatch(current_path[0], current_filter[0]):
+        return filter_check(current_path[1:], current_filter[1:])
+
+    else:
+        return False
+
+
+# fnmatch ignores case on some platforms, in which case literal segments
+# can't be looked up directly.
+_CASE_SENSITIVE = os.path.normcase("A") == "A"
+_GLOB_MAGIC = re.compile("[*?[]")
+
+# Key of a trie node holding the full path of the file ending there
+_FILE_KEY = ""
+
+
+class PathTrie:
+    """The directory tree of a mod, to answer glob queries without a full scan."""
+
+    root: Dict[str, Any]
+
+    def __init__(self, paths: Iterable[str]):
+        self.root = {}
 
-            def filter_check(
-                current_path: List[str], current_filter: Tuple[str, ...]
-            ) -> bool:
-                if len(current_filter) == 0 and len(current_path) == 0:
-                    return True
+        for path in paths:
+            node = self.root
+            for part in path.split("/"):
+                node = node.setdefault(part, {})
+            node[_FILE_KEY] = path
 
-                if len(current_filter) == 0 or len(current_path) == 0:
-                    return False
+    def glob(self, filter_parts: Tuple[str, ...]) -> Set[str]:
+        """Find all paths matching the glob, with the semantics of filter_check."""
+        found: Set[str] = set()
+        self._walk(self.root, filter_parts, found, set())
+        return found
 
-                if current_filter[0] == "**":
-                    # recursivly absorb path members
-                    # This could get very slow with multiple '**'s
-                    for i in range(len(current_path)):
-                        if filter_check(current_path[i:], current_filter[1:]):
-                            return True
-                    return False
+    def _walk(
+        self,
+        node: Dict[str, Any],
+        filter_parts: Tuple[str, ...],
+        found: Set[str],
+        visited: Set[Tuple[int, int]],
+    ) -> None:
+        # With several '**' the same node can be reached many times with
+        # the same remaining glob, there is no need to walk it again.
+        state = (id(node), len(filter_parts))
+        if state in visited:
+            return
+        visited.add(state)
 
-                elif fnmatch(current_path[0], current_filter[0]):
-                    return filter_check(current_path[1:], current_filter[1:])
+        if len(filter_parts) == 0:
+            if _FILE_KEY in node:
+                found.add(node[_FILE_KEY])
+            return
 
+        part, rest = filter_parts[0], filter_parts[1:]
+
+        if part == "**":
+            # '**' absorbs zero or more directories, but never the file itself
+            if len(rest) == 0:
+                return
+
+            self._walk(node, rest, found, visited)
+            for name, child in node.items():
+                if name != _FILE_KEY:
+                    self._walk(child, filter_parts, found, visited)
+
+        elif _CASE_SENSITIVE and not _GLOB_MAGIC.search(part):
+            child = node.get(part)
+            if child is not None and part != _FILE_KEY:
+                self._walk(child, rest, found, visited)
+
+        else:
+            for name, child in node.items():
+                if name != _FILE_KEY and fnmatch(name, part):
+                    self._walk(child, rest, found, visited)
+
+
+class Mod:
+    mod_path: Path
+    all_files: Set[str]
+    name: str
+    file_prefix: str
+    mod_type: str
+    trie: PathTrie
+
+    def __init__(self, mod_name: str, mod_path: Path):
+        self.mod_path = mod_path
+        self.name = mod_name
+        self.mod_type = "file" if self.mod_path.is_dir() else "zip"
+
+        index = mod_index(mod_path.parent)
+        indexed = index.files(mod_path) if index is not None else None
+
+        if indexed is not None:
+            # click.echo writes whole lines, mods load from several threads
+            click.echo(f"Loading: {mod_name} -> {mod_path} (indexed)")
+            self.file_prefix = indexed["prefix"]
+            self.all_files = set(indexed["files"])
+
+            if self.mod_type == "zip":
+                _zip_crcs[mod_path] = {
+                    self.file_prefix + f: (crc, size)
+                    for f, (crc, size) in indexed["files"].items()
+                }
+
+        else:
+            click.echo(f"Loading: {mod_name} -> {mod_path}")
+
+            if self.mod_type == "file":
+                self._scan_directory()
+            else:
+                self._scan_zip()
+
+            if index is not None:
+                if self.mod_type == "file":
+                    index.store(
+                        mod_path,
+                        self.file_prefix,
+                        sorted(self.all_files),
+                        self.directories,
+                    )
                 else:
-                    return False
+                    crcs = zip_crcs(mod_path)
+                    index.store(
+                        mod_path,
+                        self.file_prefix,
+                        {f: crcs[self.file_prefix + f] for f in self.all_files},
+                    )
+
+        # Indexed here, so it's done by the startup threads
+        self.trie = PathTrie(self.all_files)
+
+    def _scan_directory(self) -> None:
+        # File baised mod
+        self.file_prefix = ""
+        self.all_files = set()
+        # The mtime of every directory, for the mod index
+        self.directories: Dict[str, int] = {}
+
+        for dir_path, _, file_names in os.walk(self.mod_path, followlinks=True):
+            directory = Path(dir_path).relative_to(self.mod_path).as_posix()
+            self.directories[directory] = os.stat(dir_path).st_mtime_ns
+
+            prefix = "" if directory == "." else directory + "/"
+            self.all_files.update(
+                prefix + file_name
+                for file_name in file_names
+                if file_name.endswith(".png")
+            )
+
+    def _scan_zip(self) -> None:
+        # Zipped baised mod
+        zfile = zip_reader(self.mod_path).zfile
+
+        # There should be exactly 1x folder withing the root of the mod
+        self.file_prefix = zfile.namelist()[0].split("/")[0] + "/"
+
+        self.all_files = set()
+
+        for f in zfile.namelist():
+            f = str(f)
+
+            assert f.startswith(self.file_prefix), (
+                f"Mod {self.name} has file '{f}' with invalid name"
+                f" (Not starting with '{self.file_prefix}')"
+            )
+
+            if not f.endswith("png"):
+                continue
+
+            self.all_files.add(f[len(self.file_prefix) :])
 
-            if filter_check(f.split("/"), filter_s):
-                yield f
+    def files(self, filter: Path) -> Iterable[str]:
+        return self.trie.glob(filter.parts)
 
     def lazy_file(self, path: str) -> LazyFile:
         assert path in self.all_files, f"File {path} doesn't exist in mod {self.name}"
@@ -118,48 +737,63 @@ def split_version(version: str) -> Optional[List[int]]:
     try:
         return [int(d) for d in version.split(".")]
     except:
-        print(f"Unable to parse version: '{version}'")
+        click.echo(f"Unable to parse version: '{version}'")
         return None
 
 
-def find_mod(mod_name: str, source_dirs: List[Path]) -> Path:
-    for mod_root in source_dirs:
-        found_mod_path = None
-        found_mod_version = None
+def find_mod_entry(mod_name: str, entries: Iterable[str]) -> Optional[str]:
+    """Pick the entry of a source directory holding the newest version of a mod."""
+    found_mod_entry = None
+    found_mod_version = None
+
+    for file_name in entries:
+        if file_name == mod_name:
+            return file_name
+
+        elif file_name == mod_name + ".zip":
+            return file_name
 
-        for f in mod_root.iterdir():
-            file_name = f.name
+        elif "_" not in file_name:
+            continue
 
-            if file_name == mod_name:
-                return mod_root / f
+        else:
+            file_name_s = file_name.split("_")
+            f_name = "_".join(file_name_s[:-1])
+            f_version = file_name_s[-1]
 
-            elif file_name == mod_name + ".zip":
-                return mod_root / f
+            if file_name.endswith(".zip"):
+                f_version = f_version[: -len(".zip")]
 
-            elif "_" not in file_name:
+            if f_name != mod_name:
                 continue
 
-            else:
-                file_name_s = file_name.split("_")
-                f_name = "_".join(file_name_s[:-1])
-                f_version = file_name_s[-1]
+            f_version_split = split_version(f_version)
+            if f_version_split is None:
+                continue
 
-                if file_name.endswith(".zip"):
-                    f_version = f_version[: -len(".zip")]
+            if found_mod_version is None or f_version_split > found_mod_version:
+                found_mod_entry = file_name
+                found_mod_version = f_version_split
 
-                if f_name != mod_name:
-                    continue
+    return found_mod_entry
 
-                f_version_split = split_version(f_version)
-                if f_version_split is None:
-                    continue
 
-                if found_mod_version is None or f_version_split > found_mod_version:
-                    found_mod_path = mod_root / f
-                    found_mod_version = f_version_split
+def find_mod(mod_name: str, source_dirs: List[Path]) -> Path:
+    for mod_root in source_dirs:
+        index = mod_index(mod_root)
+
+        if index is not None:
+            found_mod_path = index.resolve(mod_name)
+        else:
+            found_mod_entry = find_mod_entry(
+                mod_name, (f.name for f in mod_root.iterdir())
+            )
+            found_mod_path = (
+                mod_root / found_mod_entry if found_mod_entry is not None else None
+            )
 
-        if found_mod_path != None:
-            return found_mod_path  # type: ignore
+        if found_mod_path is not None:
+            return found_mod_path
 
     raise Exception(f"Could not find mod: {mod_name}. Has it been installed?")
 
@@ -167,10 +801,22 @@ def find_mod(mod_name: str, source_dirs: List[Path]) -> Path:
 global_mod_cache: Dict[str, Mod] = {}
 
 
-def open_mod_read(mod_name: str, source_dirs: List[Path]) -> Mod:
-    if mod_name not in global_mod_cache:
-        mod_path = find_mod(mod_name, source_dirs)
+_mod_locks: Dict[str, threading.Lock] = {}
+_mod_locks_lock = threading.Lock()
 
-        global_mod_cache[mod_name] = Mod(mod_name, mod_path)
+
+def open_mod_read(mod_name: str, source_dirs: List[Path]) -> Mod:
+    # Mods are loaded from several threads at startup, make sure each one
+    # is only indexed once while letting different mods load in parallel.
+    with _mod_locks_lock:
+        mod_lock = _mod_locks.setdefault(mod_name, threading.Lock())
+
+    with mod_lock:
+        if mod_name not in global_mod_cache:
+            with timed("mod resolution"):
+                mod_path = find_mod(mod_name, source_dirs)
+
+            with timed("mod indexing"):
+                global_mod_cache[mod_name] = Mod(mod_name, mod_path)
 
     return global_mod_cache[mod_name]
@@ -0,0 +1,204 @@
+"""Where the files of a built pack are written."""
+import json
+import os
+import threading
+import zipfile
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+import click
+
+# Bump whenever the content of the manifest files changes
+MANIFEST_VERSION = 1
+MANIFEST_NAME = ".noir-manifest.json"
+
+
+class PackOutput:
+    """Destination of the files of a pack, relative to the pack root."""
+
+    location: Path
+
+    def is_current(self, path: str, fingerprint: str) -> bool:
+        """Whether the file at path is already the one with this fingerprint.
+
+        If it is, the file is kept as is and doesn't need to be written again.
+        """
+        return False
+
+    def write(
+        self,
+        path: str,
+        data: bytes,
+        compress: bool = True,
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        raise NotImplementedError
+
+    def copy(self, path: str, source_file: Path) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def abort(self) -> None:
+        """Give up on a pack that failed to build."""
+        pass
+
+
+class DirectoryOutput(PackOutput):
+    """Write the pack as a plain directory, used by --dev.
+
+    The directory is synced rather than rebuilt: a manifest records the
+    fingerprint of every sprite, so that unchanged sprites are not written
+    again, and files that are not part of the pack anymore are removed when
+    it is closed.
+    """
+
+    def __init__(self, target_dir: Path, reuse: bool = True):
+        self.location = target_dir
+        self.manifest_path = target_dir / MANIFEST_NAME
+        # Whether unchanged sprites are kept, False to write them all again
+        self.reuse = reuse
+
+        self.previous: Dict[str, str] = {}
+        self.fingerprints: Dict[str, str] = {}
+        # Every file of the pack being built, written or not
+        self.files: Set[str] = set()
+        self.written = 0
+
+        try:
+            with self.manifest_path.open() as f:
+                manifest = json.load(f)
+            if manifest["version"] == MANIFEST_VERSION:
+                self.previous = manifest["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def is_current(self, path: str, fingerprint: str) -> bool:
+        if not self.reuse or self.previous.get(path) != fingerprint:
+            return False
+
+        if not (self.location / path).is_file():
+            return False
+
+        self.files.add(path)
+        self.fingerprints[path] = fingerprint
+        return True
+
+    def write(
+        self,
+        path: str,
+        data: bytes,
+        compress: bool = True,
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        self.files.add(path)
+        target_file_path = self.location / path
+
+        if fingerprint is not None:
+            self.fingerprints[path] = fingerprint
+
+        # Files without fingerprints are small, compare them to what's there
+        elif target_file_path.is_file() and target_file_path.read_bytes() == data:
+            return
+
+        target_file_path.parent.mkdir(exist_ok=True, parents=True)
+        target_file_path.write_bytes(data)
+        self.written += 1
+
+    def copy(self, path: str, source_file: Path) -> None:
+        self.write(path, source_file.read_bytes())
+
+    def save_manifest(self, fingerprints: Dict[str, str]) -> None:
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump({"version": MANIFEST_VERSION, "files": fingerprints}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def close(self) -> None:
+        removed = 0
+        for target_file_path in sorted(self.location.glob("**/*"), reverse=True):
+            if target_file_path == self.manifest_path:
+                continue
+
+            path = target_file_path.relative_to(self.location).as_posix()
+            if target_file_path.is_dir():
+                # Children come first, so emptied directories are already empty
+                if not any(target_file_path.iterdir()):
+                    target_file_path.rmdir()
+
+            elif path not in self.files:
+                target_file_path.unlink()
+                removed += 1
+
+        self.save_manifest(self.fingerprints)
+
+        click.secho(
+            f"Synced {self.location}: {self.written} files written, "
+            f"{len(self.files) - self.written} unchanged, {removed} removed",
+            fg="green",
+        )
+
+    def abort(self) -> None:
+        # Files not written yet are still what the previous build left
+        self.save_manifest({**self.previous, **self.fingerprints})
+
+
+class ZipOutput(PackOutput):
+    """Stream the pack straight into its final zip archive."""
+
+    def __init__(self, zip_path: Path, root_dir: str):
+        self.location = zip_path
+        self.root_dir = root_dir
+        self._lock = threading.Lock()
+
+        # Only replace the previous archive once this one is complete
+        self._tmp_path = zip_path.with_name(zip_path.name + ".tmp")
+        # Opened on the first write, so that nothing is left behind by a pack
+        # failing before it starts writing
+        self._zfile: Optional[zipfile.ZipFile] = None
+
+    def _archive(self) -> zipfile.ZipFile:
+        """The archive being written, to call with the lock held."""
+        if self._zfile is None:
+            self.location.parent.mkdir(parents=True, exist_ok=True)
+            self._zfile = zipfile.ZipFile(self._tmp_path, "w")
+        return self._zfile
+
+    def write(
+        self,
+        path: str,
+        data: bytes,
+        compress: bool = True,
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        # PNG data barely compresses, it's not worth deflating it again
+        compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+
+        with self._lock:
+            self._archive().writestr(
+                f"{self.root_dir}/{path}", data, compress_type=compress_type
+            )
+
+    def copy(self, path: str, source_file: Path) -> None:
+        with self._lock:
+            self._archive().write(
+                source_file,
+                f"{self.root_dir}/{path}",
+                compress_type=zipfile.ZIP_DEFLATED,
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._archive().close()
+            self._zfile = None
+            os.replace(self._tmp_path, self.location)
+
+    def abort(self) -> None:
+        with self._lock:
+            if self._zfile is None:
+                return
+
+            self._zfile.close()
+            self._zfile = None
+            self._tmp_path.unlink()
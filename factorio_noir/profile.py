@@ -0,0 +1,130 @@
+"""Collect the cost of every rendered sprite, for --profile-report."""
+import json
+import threading
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, DefaultDict, Dict, List
+
+import click
+
+from factorio_noir.render import SpriteStats
+
+# How many entries the summary lists for each ranking
+SUMMARY_SIZE = 20
+
+STAGES = ["decode_time", "transform_time", "resize_time", "encode_time"]
+
+
+@dataclass
+class SpriteProfile:
+    """Where a rendered sprite comes from, and what it cost."""
+
+    lua_path: str
+    category: str
+    mod: str
+    stats: SpriteStats
+
+
+class ProfileReport:
+    """Per sprite render costs, summarized by category and by mod."""
+
+    def __init__(self) -> None:
+        self.sprites: List[SpriteProfile] = []
+        self._lock = threading.Lock()
+
+    def add(self, lua_path: str, category: str, mod: str, stats: SpriteStats) -> None:
+        with self._lock:
+            self.sprites.append(SpriteProfile(lua_path, category, mod, stats))
+
+    def totals(self, key: str) -> List[Dict[str, Any]]:
+        """Sum the sprite costs by category or by mod, most expensive first."""
+        groups: DefaultDict[str, Dict[str, Any]] = defaultdict(
+            lambda: {"sprites": 0, "total_time": 0.0, "pixels": 0, "bytes_read": 0}
+        )
+
+        for sprite in self.sprites:
+            group = groups[getattr(sprite, key)]
+            group["sprites"] += 1
+            group["total_time"] += sprite.stats.total_time
+            group["pixels"] += sprite.stats.width * sprite.stats.height
+            group["bytes_read"] += sprite.stats.bytes_read
+            for stage in STAGES:
+                group[stage] = group.get(stage, 0.0) + getattr(sprite.stats, stage)
+
+        return sorted(
+            ({key: name, **group} for name, group in groups.items()),
+            key=lambda group: group["total_time"],
+            reverse=True,
+        )
+
+    def sprite_entry(self, sprite: SpriteProfile) -> Dict[str, Any]:
+        entry = {
+            "lua_path": sprite.lua_path,
+            "category": sprite.category,
+            "mod": sprite.mod,
+            **asdict(sprite.stats),
+        }
+        entry["total_time"] = sprite.stats.total_time
+        return entry
+
+    def write(self, report_path: Path) -> None:
+        slowest = sorted(
+            self.sprites, key=lambda sprite: sprite.stats.total_time, reverse=True
+        )
+
+        report = {
+            "summary": {
+                "sprites": len(self.sprites),
+                "total_time": sum(sprite.stats.total_time for sprite in self.sprites),
+                "slowest_sprites": [
+                    self.sprite_entry(sprite) for sprite in slowest[:SUMMARY_SIZE]
+                ],
+                "categories": self.totals("category")[:SUMMARY_SIZE],
+                "mods": self.totals("mod")[:SUMMARY_SIZE],
+            },
+            "sprites": [self.sprite_entry(sprite) for sprite in self.sprites],
+        }
+
+        with report_path.open("w") as f:
+            json.dump(report, f, indent=4)
+
+        click.secho(
+            f"Profiled {len(self.sprites)} rendered sprites: {report_path}",
+            fg="green",
+        )
+        for title, key, entries in (
+            ("Slowest sprites", "lua_path", report["summary"]["slowest_sprites"]),
+            ("Most expensive categories", "category", report["summary"]["categories"]),
+            ("Most expensive mods", "mod", report["summary"]["mods"]),
+        ):
+            click.echo(f"  {title}:")
+            for entry in entries[:5]:
+                click.echo(f"    {entry['total_time']:7.2f}s {entry[key]}")
+
+
+class WorkerMemory:
+    """The peak memory of each worker process, from the stats of its sprites."""
+
+    def __init__(self) -> None:
+        self.peaks: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stats: SpriteStats) -> None:
+        if stats.peak_memory is None:
+            # Not measured on this platform
+            return
+
+        with self._lock:
+            peak = self.peaks.get(stats.worker, 0)
+            self.peaks[stats.worker] = max(peak, stats.peak_memory)
+
+    def report(self) -> None:
+        if len(self.peaks) == 0:
+            return
+
+        peaks = sorted(self.peaks.values(), reverse=True)
+        click.echo(
+            f"Peak memory of the {len(peaks)} workers: {peaks[0]} MiB "
+            f"(each: {', '.join(str(peak) for peak in peaks)} MiB)"
+        )
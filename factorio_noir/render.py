@@ -1,45 +1,159 @@
 """Render a modified sprite."""
 
-from pathlib import Path
-
-from functools import lru_cache
+import copy
+import io
+import os
+import sys
+import time
+import zlib
+
+from collections import OrderedDict
+from functools import lru_cache, partial
 from dataclasses import dataclass
-from PIL import Image  # type: ignore
-from typing import List, Optional, Tuple, Iterable, NewType
+from PIL import Image, ImageFilter  # type: ignore
+from typing import Any, Callable, Dict, List, Optional, Tuple, Iterable, NewType
+import bisect
+import colorsys
 import math
 
-from factorio_noir.category import SpriteTreatment
-from factorio_noir.mod import LazyFile
+try:
+    import numpy as np  # type: ignore
+except ImportError:
+    # NumPy is only needed by the numpy transform engine
+    np = None
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported
+    resource = None  # type: ignore
+
+from factorio_noir.category import HUES, SpriteTreatment, tile_boxes
+from factorio_noir.mod import LazyFile, MemoryReader
 
 Matrix = NewType("Matrix", List[List[float]])
 
+# Points on each axis of the 3D lookup tables, Pillow interpolates between them
+LUT_SIZE = 33
+
+# Sprites bigger than the strip threshold are transformed in horizontal strips
+# of about this many pixels, see transform_strips
+STRIP_PIXELS = 2 ** 20
+
+# Pillow PNG encoder settings, see benchmarks/encode.py. compress_type is the
+# zlib strategy, optimize makes Pillow search harder for the best encoding.
+ENCODE_PROFILES: Dict[str, Dict[str, Any]] = {
+    # For --dev iterations: about 3.4x faster than default, and 18% bigger
+    "fast": {"compress_level": 1, "compress_type": zlib.Z_DEFAULT_STRATEGY},
+    # Pillow defaults
+    "default": {"compress_level": 6, "compress_type": zlib.Z_DEFAULT_STRATEGY},
+    # For published packs, smallest files at the cost of encoding time
+    "release": {
+        "compress_level": 9,
+        "compress_type": zlib.Z_FILTERED,
+        "optimize": True,
+    },
+}
+
+
+@dataclass
+class SpriteStats:
+    """Measurements of a single sprite render, times are in seconds."""
+
+    width: int
+    height: int
+    bytes_read: int
+    bytes_written: int
+    decode_time: float
+    transform_time: float
+    resize_time: float
+    encode_time: float
+    # Process rendering the sprite, and the most memory it used so far in MiB
+    worker: int = 0
+    peak_memory: Optional[int] = None
+
+    @property
+    def total_time(self) -> float:
+        return (
+            self.decode_time + self.transform_time + self.resize_time + self.encode_time
+        )
+
+
+def peak_memory() -> Optional[int]:
+    """The most memory used by this process so far in MiB, if known."""
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in KiB, macOS in bytes
+    if sys.platform == "darwin":
+        max_rss //= 1024
+    return max_rss // 1024
+
 
 def process_sprite(
     lazy_source_file: LazyFile,
-    lazy_match_size_file: Optional[LazyFile],
-    target_file_path: Path,
+    new_size: Optional[Tuple[int, int]],
     treatment: SpriteTreatment,
     bright: bool,
-) -> None:
-    """Process a sprite"""
-
-    target_file_path.parent.mkdir(exist_ok=True, parents=True)
-
-    if lazy_match_size_file is not None:
-        with lazy_match_size_file.open() as match_size_file:
-            new_size = Image.open(match_size_file).size
+    encode: str = "default",
+    engine: str = "pillow",
+    strip_threshold: Optional[int] = None,
+) -> Tuple[bytes, SpriteStats]:
+    """Process a sprite, returning the encoded PNG and how long each step took.
+
+    The sprite is resized to new_size, if given. Sprites with more than
+    strip_threshold pixels are transformed strip by strip.
+    """
+    start = time.perf_counter()
+
+    source_data = lazy_source_file.read()
+    bytes_read = len(source_data)
+
+    # Stored zip entries are decoded straight from the memory-mapped archive
+    try:
+        with MemoryReader(source_data) as source:
+            sprite = Image.open(source)
+            sprite.load()
+    except (OSError, ValueError) as e:
+        # The reader has no name, say which sprite failed
+        raise ValueError(
+            f"{lazy_source_file.mod_path}: {lazy_source_file.file_path}: {e}"
+        ) from e
+    del source_data
+    if sprite.mode != "RGBA":
+        sprite = sprite.convert("RGBA")
+    width, height = sprite.size
+    decoded = time.perf_counter()
+
+    if strip_threshold is not None and width * height > strip_threshold:
+        processed_sprite = transform_strips(sprite, treatment, bright, engine)
     else:
-        new_size = None
-
-    with lazy_source_file.open() as source_file:
-        sprite = Image.open(source_file).convert("RGBA")
-        processed_sprite = apply_transforms(
-            sprite,
-            treatment,
-            bright,
-            new_size,
-        )
-        processed_sprite.save(target_file_path)
+        processed_sprite = TRANSFORM_ENGINES[engine](sprite, treatment, bright)
+    del sprite
+    transformed = time.perf_counter()
+
+    if new_size is not None and processed_sprite.size != new_size:
+        processed_sprite = processed_sprite.resize(new_size)
+    resized = time.perf_counter()
+
+    output = io.BytesIO()
+    processed_sprite.save(output, format="PNG", **ENCODE_PROFILES[encode])
+    encoded = time.perf_counter()
+
+    stats = SpriteStats(
+        width=width,
+        height=height,
+        bytes_read=bytes_read,
+        bytes_written=output.tell(),
+        decode_time=decoded - start,
+        transform_time=transformed - decoded,
+        resize_time=resized - transformed,
+        encode_time=encoded - resized,
+        worker=os.getpid(),
+        peak_memory=peak_memory(),
+    )
+    return output.getvalue(), stats
 
 
 @dataclass(eq=True, frozen=True)
@@ -178,16 +292,8 @@ class ColorSpace:
         return sum(e1 * e2 for (e1, e2) in zip(v1, v2))
 
 
-def apply_transforms(
-    image: Image,
-    treatment: SpriteTreatment,
-    bright: bool,
-    new_size: Optional[Tuple[float, float]],
-) -> Image:
-    """Apply the needed transformations to the given image."""
-    img_alpha = image.getchannel("A")
-    img_rgb = image.convert("RGB")
-
+def treatment_matrix(treatment: SpriteTreatment, bright: bool) -> List[float]:
+    """Return the flat 3x4 color matrix of a treatment."""
     sat = treatment.saturation
     bri = treatment.brightness
 
@@ -198,27 +304,319 @@ def apply_transforms(
         if bri <= 0.9:
             bri += 0.1
 
-    transformation_matrix = ColorSpace(*treatment.color_space).matrix(
-        sat, bri, treatment.hue
+    return ColorSpace(*treatment.color_space).matrix(sat, bri, treatment.hue)
+
+
+def _hue_saturation(treatment: SpriteTreatment, hue: float) -> float:
+    """Saturation of a hue, interpolated between the evenly spaced HUES."""
+    saturations = [treatment.hue_saturation.get(name, 1.0) for name in HUES]
+
+    position = hue * len(saturations)
+    index = int(position) % len(saturations)
+    before = saturations[index]
+    # Magenta wraps around to red
+    after = saturations[(index + 1) % len(saturations)]
+
+    return before + (after - before) * (position - int(position))
+
+
+def _curve(points: List[Tuple[float, float]], value: float) -> float:
+    """Interpolate linearly between the points of a curve."""
+    index = bisect.bisect_left(points, (value,))
+    if index == 0:
+        return points[0][1]
+    if index == len(points):
+        return points[-1][1]
+
+    (x1, y1), (x2, y2) = points[index - 1], points[index]
+    return y1 + (y2 - y1) * (value - x1) / (x2 - x1)
+
+
+def _clamp(value: float) -> float:
+    return 0.0 if value < 0.0 else 1.0 if value > 1.0 else value
+
+
+def matrix_color(
+    matrix: List[float], r: float, g: float, b: float
+) -> Tuple[float, float, float]:
+    """Apply a flat 3x4 color matrix to a single color, channels are in [0, 1]."""
+    return (
+        _clamp(matrix[0] * r + matrix[1] * g + matrix[2] * b),
+        _clamp(matrix[4] * r + matrix[5] * g + matrix[6] * b),
+        _clamp(matrix[8] * r + matrix[9] * g + matrix[10] * b),
     )
 
-    img_converted = img_rgb.convert("RGB", transformation_matrix)
 
-    for bounding_box, tile_strength in treatment.tiles(image.width, image.height):
-        if tile_strength == 1:
-            # we are wanting this tile left untouched
-            continue
+def tone(treatment: SpriteTreatment, value: float) -> float:
+    """Apply the per channel steps of a treatment: contrast, gamma and curve."""
+    value = _clamp((value - 0.5) * treatment.contrast + 0.5)
+
+    if treatment.gamma != 1:
+        value = value ** (1 / treatment.gamma)
+
+    if len(treatment.curve) > 0:
+        value = _curve(treatment.curve, value)
+
+    return value
+
+
+def treatment_color(
+    treatment: SpriteTreatment, matrix: List[float], r: float, g: float, b: float
+) -> Tuple[float, float, float]:
+    """Apply a whole treatment to a single color, channels are in [0, 1]."""
+    red, green, blue = matrix_color(matrix, r, g, b)
+
+    if treatment.per_hue:
+        # The hue of the source color, the matrix may have washed it out
+        saturation = _hue_saturation(treatment, colorsys.rgb_to_hsv(r, g, b)[0])
+        x, y, z = treatment.color_space
+        luma = red * x + green * y + blue * z
+        red = luma + (red - luma) * saturation
+        green = luma + (green - luma) * saturation
+        blue = luma + (blue - luma) * saturation
+
+    return tone(treatment, red), tone(treatment, green), tone(treatment, blue)
 
-        image_box = img_rgb.crop(bounding_box)
-        converted_box = img_converted.crop(bounding_box)
 
-        blended_box = Image.blend(image_box, converted_box, tile_strength)
+def tone_table(treatment: SpriteTreatment) -> List[int]:
+    """The tone curve of a treatment as a Image.point table, for RGB images."""
+    return [round(tone(treatment, i / 255) * 255) for i in range(256)] * 3
+
+
+# Compiled once per treatment, in each worker process
+_luts: Dict[Tuple[str, bool], ImageFilter.Color3DLUT] = {}
+
+
+def treatment_lut(treatment: SpriteTreatment, bright: bool) -> ImageFilter.Color3DLUT:
+    """Compile a treatment, color matrix and nonlinear steps, into a 3D LUT."""
+    key = (repr(treatment), bright)
+    if key not in _luts:
+        matrix = treatment_matrix(treatment, bright)
+        if treatment.per_hue or treatment.tonal:
+            callback = partial(treatment_color, treatment, matrix)
+        else:
+            callback = partial(matrix_color, matrix)
+
+        _luts[key] = ImageFilter.Color3DLUT.generate(LUT_SIZE, callback)
+
+    return _luts[key]
+
+
+# Bytes of tile masks each worker keeps, masks have one byte per pixel. Sprites
+# of a category often share their size, so masks are reused a lot.
+MASK_CACHE_SIZE = 32 * 2 ** 20
+
+TilingKey = Tuple[Tuple[Tuple[float, ...], ...], int, int, float]
+
+_masks: "OrderedDict[TilingKey, Image]" = OrderedDict()
+_masks_size = 0
+
+
+def _tile_mask(
+    tiling: Tuple[Tuple[float, ...], ...],
+    width: int,
+    height: int,
+    smoothing: float,
+    box: Optional[Tuple[int, int, int, int]] = None,
+) -> Image:
+    """The mask of the whole sprite, or only of the given box of it."""
+    if box is None:
+        box = (0, 0, width, height)
 
-        img_converted.paste(blended_box, bounding_box)
+    # The blur needs the pixels around the box. Where the box touches the
+    # edges of the sprite, they are extended the same way as for a full mask.
+    margin = math.ceil(smoothing * 3) + 1 if smoothing > 0 else 0
+    left, top = max(0, box[0] - margin), max(0, box[1] - margin)
+    right, bottom = min(width, box[2] + margin), min(height, box[3] + margin)
+
+    mask = Image.new("L", (right - left, bottom - top), 255)
+    for (x1, y1, x2, y2), tile_strength in tile_boxes(tiling, width, height):
+        x1, y1 = max(x1, left) - left, max(y1, top) - top
+        x2, y2 = min(x2, right) - left, min(y2, bottom) - top
+        if tile_strength != 1 and x1 < x2 and y1 < y2:
+            mask.paste(round(tile_strength * 255), (x1, y1, x2, y2))
+
+    if smoothing > 0:
+        mask = mask.filter(ImageFilter.GaussianBlur(smoothing))
+
+    return mask.crop((box[0] - left, box[1] - top, box[2] - left, box[3] - top))
+
+
+def tile_mask(treatment: SpriteTreatment, width: int, height: int) -> Image:
+    """The strength of the treatment for each pixel, 255 is fully converted.
+
+    Masks are cached and shared, they must not be modified.
+    """
+    global _masks_size
+
+    tiling = tuple(tuple(row) for row in treatment.tiling)
+    key = (tiling, width, height, treatment.tile_smoothing)
+
+    mask = _masks.get(key)
+    if mask is not None:
+        _masks.move_to_end(key)
+        return mask
+
+    mask = _tile_mask(*key)
+    if width * height <= MASK_CACHE_SIZE:
+        _masks[key] = mask
+        _masks_size += width * height
+
+        # Least recently used first
+        while _masks_size > MASK_CACHE_SIZE:
+            _, evicted = _masks.popitem(last=False)
+            _masks_size -= evicted.width * evicted.height
+
+    return mask
+
+
+def blend_tiles(image: Image, converted: Image, treatment: SpriteTreatment) -> Image:
+    """Blend the converted image with the source, by the strength of each tile."""
+    if not treatment.tiled:
+        return converted
+
+    mask = tile_mask(treatment, image.width, image.height)
+    return Image.composite(converted, image, mask)
+
+
+def apply_transforms(
+    image: Image,
+    treatment: SpriteTreatment,
+    bright: bool,
+) -> Image:
+    """Apply the needed transformations to the given image."""
+    if treatment.per_hue:
+        # Pillow has nothing faster for it than a LUT
+        return apply_transforms_lut(image, treatment, bright)
+
+    img_alpha = image.getchannel("A")
+    img_rgb = image.convert("RGB")
+
+    transformation_matrix = treatment_matrix(treatment, bright)
+
+    img_converted = img_rgb.convert("RGB", transformation_matrix)
+    if treatment.tonal:
+        img_converted = img_converted.point(tone_table(treatment))
+    img_converted = blend_tiles(img_rgb, img_converted, treatment)
 
     img_converted.putalpha(img_alpha)
 
-    if new_size is not None and img_converted.size != new_size:
-        img_converted = img_converted.resize(new_size)
+    return img_converted
+
+
+def apply_transforms_lut(
+    image: Image,
+    treatment: SpriteTreatment,
+    bright: bool,
+) -> Image:
+    """Same as apply_transforms, in a single pass through the treatment's LUT.
+
+    The cost doesn't depend on how many steps the treatment has, but a LUT is
+    several times slower than a color matrix, see benchmarks/lut.py. Results
+    match apply_transforms within 2 units.
+    """
+    lut = treatment_lut(treatment, bright)
+
+    if not treatment.tiled:
+        # The LUT leaves alpha in place
+        return image.filter(lut)
+
+    img_alpha = image.getchannel("A")
+    img_rgb = image.convert("RGB")
+
+    img_converted = blend_tiles(img_rgb, img_rgb.filter(lut), treatment)
+    img_converted.putalpha(img_alpha)
 
     return img_converted
+
+
+def apply_transforms_numpy(
+    image: Image,
+    treatment: SpriteTreatment,
+    bright: bool,
+) -> Image:
+    """Same as apply_transforms, computed on the RGBA buffer with NumPy.
+
+    About 3 times slower than apply_transforms, see benchmarks/engines.py:
+    converting the pixels to floats alone costs more than Pillow's whole
+    matrix conversion. It is kept as a reference, never used by default.
+    Rounding mimics Pillow, results match apply_transforms within 1 unit.
+    """
+    if treatment.per_hue or treatment.tonal:
+        # Only the color matrix is implemented here
+        return apply_transforms(image, treatment, bright)
+
+    pixels = np.asarray(image)
+    rgb = pixels[..., :3].astype(np.float32)
+
+    matrix = np.array(treatment_matrix(treatment, bright), dtype=np.float32)
+    matrix = matrix.reshape(3, 4)[:, :3]
+
+    # Pillow rounds the converted image before blending it
+    converted = np.matmul(rgb, matrix.T)
+    converted += 0.5
+    np.floor(converted, out=converted)
+    np.clip(converted, 0, 255, out=converted)
+
+    if treatment.tiled:
+        mask = np.asarray(tile_mask(treatment, image.width, image.height))
+
+        # (converted * mask + rgb * (255 - mask)) / 255, rounded like Pillow.
+        # Everything is done in place, rgb isn't needed afterwards.
+        converted -= rgb
+        converted *= mask[..., np.newaxis]
+        rgb *= 255
+        converted += rgb
+        converted /= 255
+        converted += 0.5
+        np.floor(converted, out=converted)
+
+    result = np.empty_like(pixels)
+    result[..., 3] = pixels[..., 3]
+    result[..., :3] = converted
+    return Image.fromarray(result, "RGBA")
+
+
+TRANSFORM_ENGINES: Dict[str, Callable[..., Image]] = {
+    "pillow": apply_transforms,
+    "numpy": apply_transforms_numpy,
+    "lut": apply_transforms_lut,
+}
+
+
+def transform_strips(
+    image: Image,
+    treatment: SpriteTreatment,
+    bright: bool,
+    engine: str = "pillow",
+) -> Image:
+    """Same as the engine's transform, one horizontal strip at a time.
+
+    The engines keep several full size copies of the sprite, here only the
+    sprite and the copies of a single strip are in memory. Each strip is
+    written back into the given image, which is returned.
+    """
+    transform = TRANSFORM_ENGINES[engine]
+
+    # The tiles are blended here, with the mask of each strip
+    tiled = treatment.tiled
+    tiling = tuple(tuple(row) for row in treatment.tiling)
+    smoothing = treatment.tile_smoothing
+    if tiled:
+        # Its fields are already parsed, don't run them through the converters
+        treatment = copy.copy(treatment)
+        treatment.tiling = [[1.0]]
+
+    strip_height = max(1, STRIP_PIXELS // image.width)
+    for top in range(0, image.height, strip_height):
+        box = (0, top, image.width, min(top + strip_height, image.height))
+
+        strip = image.crop(box)
+        converted = transform(strip, treatment, bright)
+        if tiled:
+            mask = _tile_mask(tiling, image.width, image.height, smoothing, box)
+            converted = Image.composite(converted, strip, mask)
+
+        image.paste(converted, box)
+
+    return image
@@ -0,0 +1,37 @@
+"""Accumulate the time spent in each stage of a build."""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import DefaultDict, Iterator
+
+import click
+
+stage_times: DefaultDict[str, float] = defaultdict(float)
+_lock = threading.Lock()
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Add the time spent in the block to the given stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            stage_times[stage] += elapsed
+
+
+def report(label: str, wall_time: float) -> None:
+    """Print the time of each stage, compared to the wall time they took."""
+    total = sum(stage_times.values())
+
+    click.secho(f"{label} in {wall_time:.2f}s", fg="green")
+    for stage, stage_time in stage_times.items():
+        click.echo(f"  - {stage}: {stage_time:.2f}s")
+
+    click.echo(
+        f"  Run one after the other these would take {total:.2f}s, "
+        f"running them in parallel saved {max(total - wall_time, 0):.2f}s"
+    )
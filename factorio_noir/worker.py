@@ -1,43 +1,235 @@
 """Process all sprites for all the given categories."""
+import os
+import signal
+import threading
 import time
-from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+import traceback
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
 from contextlib import contextmanager
+from functools import partial
 
 import click
 
-from typing import Any, Callable, Iterable, Iterator
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Sprites are sent to workers in batches of about this cost (estimated
+# decoded bytes), so that tiny icons don't each pay a full IPC round-trip.
+BATCH_COST = 16 * 2 ** 20
+MAX_BATCH_SIZE = 64
+
+# How many batches may wait in the pool's queue for each worker
+QUEUED_BATCHES_PER_JOB = 2
+
+BatchItem = Tuple[Tuple[Any, ...], Dict[str, Any]]
+
+
+def _ignore_interrupts() -> None:
+    # Ctrl-C reaches the workers too, only the main process handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class RemoteTraceback(Exception):
+    """The traceback of an exception raised in a worker."""
+
+    def __init__(self, tb: str):
+        self.tb = tb
+
+    def __str__(self) -> str:
+        return self.tb
+
+
+def run_batch(
+    func: Callable[..., Any], batch: List[BatchItem]
+) -> List[Tuple[bool, Any]]:
+    """Run func on every item of the batch, reporting failures one by one."""
+    results: List[Tuple[bool, Any]] = []
+    for args, kwargs in batch:
+        try:
+            results.append((True, func(*args, **kwargs)))
+        except Exception as e:
+            results.append((False, (e, traceback.format_exc())))
+    return results
+
+
+class SpriteProcessor:
+    """Submit sprites to a process pool in batches, with a bounded backlog.
+
+    Calling the processor returns a future for that single sprite, resolved
+    as soon as its batch is done.
+    """
+
+    def __init__(
+        self, func: Callable[..., Any], jobs: Optional[int], max_memory: Optional[int]
+    ):
+        self.func = func
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_memory = max_memory
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.jobs, initializer=_ignore_interrupts
+        )
+
+        self.submitted = 0
+        self.error: Optional[BaseException] = None
+
+        self._batch: List[Tuple["Future[Any]", BatchItem]] = []
+        self._batch_cost = 0
+
+        # batch future -> (cost, number of sprites)
+        self._in_flight: Dict["Future[Any]", Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, *args: Any, cost: int = 0, **kwargs: Any) -> "Future[Any]":
+        self.raise_error()
+
+        future: "Future[Any]" = Future()
+        self._batch.append((future, (args, kwargs)))
+        self._batch_cost += cost
+        self.submitted += 1
+
+        if self._batch_cost >= BATCH_COST or len(self._batch) >= MAX_BATCH_SIZE:
+            self.flush()
+
+        return future
+
+    def flush(self) -> None:
+        """Send the current partial batch to the pool."""
+        if len(self._batch) == 0:
+            return
+
+        batch, cost = self._batch, self._batch_cost
+        self._batch, self._batch_cost = [], 0
+
+        self._wait_for_room(cost)
+
+        batch_future = self.pool.submit(
+            run_batch, self.func, [item for _, item in batch]
+        )
+        with self._lock:
+            self._in_flight[batch_future] = (cost, len(batch))
+
+        batch_future.add_done_callback(
+            partial(self._batch_done, [future for future, _ in batch])
+        )
+
+    def _wait_for_room(self, cost: int) -> None:
+        """Block until the pool can take a batch of the given cost."""
+        while True:
+            with self._lock:
+                # Finished batches may not have been removed by their callback yet
+                in_flight = {
+                    batch_future: batch_cost
+                    for batch_future, (batch_cost, _) in self._in_flight.items()
+                    if not batch_future.done()
+                }
+
+            in_flight_cost = sum(in_flight.values())
+            full = len(in_flight) >= self.jobs * QUEUED_BATCHES_PER_JOB or (
+                self.max_memory is not None
+                # Always let a single batch through, whatever its size
+                and in_flight_cost > 0
+                and in_flight_cost + cost > self.max_memory
+            )
+
+            if not full:
+                return
+
+            wait(in_flight, return_when=FIRST_COMPLETED)
+            self.raise_error()
+
+    def _batch_done(
+        self, futures: List["Future[Any]"], batch_future: "Future[Any]"
+    ) -> None:
+        try:
+            results = batch_future.result()
+        except BaseException as e:
+            # The whole batch failed, for instance if a worker died
+            results = [(False, (e, None))] * len(futures)
+
+        for future, (success, value) in zip(futures, results):
+            if future.cancelled():
+                continue
+
+            if success:
+                future.set_result(value)
+                continue
+
+            error, tb = value
+            if tb is not None:
+                error.__cause__ = RemoteTraceback(tb)
+
+            future.set_exception(error)
+            if self.error is None:
+                self.error = error
+
+        with self._lock:
+            del self._in_flight[batch_future]
+
+    def raise_error(self) -> None:
+        """Surface the first failed sprite as soon as it is known."""
+        if self.error is not None:
+            raise self.error
+
+    def reset_error(self) -> None:
+        """Forget a reported failure, to keep using the pool after it."""
+        self.error = None
+
+    def join(self) -> None:
+        """Wait for all submitted sprites, in completion order."""
+        self.flush()
+
+        with self._lock:
+            in_flight = dict(self._in_flight)
+
+        with click.progressbar(
+            length=self.submitted, label="Processing sprites"
+        ) as progress:
+            progress.update(self.submitted - sum(n for _, n in in_flight.values()))
+
+            for batch_future in as_completed(in_flight):
+                progress.update(in_flight[batch_future][1])
+                self.raise_error()
+
+        self.raise_error()
+
+    def cancel(self) -> None:
+        with self._lock:
+            in_flight = list(self._in_flight)
+
+        for batch_future in in_flight:
+            batch_future.cancel()
 
 
 @contextmanager
-def sprite_processor(func: Callable[..., Any]) -> Iterator[Callable[..., Any]]:
+def sprite_processor(
+    func: Callable[..., Any],
+    jobs: Optional[int] = None,
+    max_memory: Optional[int] = None,
+) -> Iterator[SpriteProcessor]:
     """Create a processor for sprites using the given function."""
     start_time = time.perf_counter()
-    processor, futures = ProcessPoolExecutor(), []
-
-    def submit(*args: Any, **kwargs: Any) -> None:
-        future = processor.submit(func, *args, **kwargs)
-        futures.append(future)
+    processor = SpriteProcessor(func, jobs, max_memory)
 
     try:
-        yield submit
-
-        with click.progressbar(futures, label="Processing sprites") as progress:
-            for future in progress:
-                future.result()
-
-    except Exception as e:
-        # Enter in error management
-        click.secho(f"Got an error, cancelling all: {e}")
-        for future in futures:
-            if not future.done():
-                future.cancel()
+        yield processor
+        processor.join()
+
+    except BaseException as e:
+        # Enter in error management, Ctrl-C included as the workers ignore it
+        click.secho(f"Got an error, cancelling all: {e!r}")
+        processor.cancel()
         raise e
 
     finally:
-        processor.shutdown()
+        processor.pool.shutdown()
 
     click.secho(
-        f"Processed {len(futures)} sprites in "
+        f"Processed {processor.submitted} sprites in "
         f"{time.perf_counter() - start_time:.1f}s",
         fg="green",
     )
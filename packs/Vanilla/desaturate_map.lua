@@ -1,13 +1,22 @@
-local function desaturate(c, bri, sat)
+-- The color matrices, and with a data.raw dump the desaturated colors, are
+-- computed by factorio_noir/map_colors.py and written to config.lua
+local map_colors = config.map_colors
+local dumped_prototypes = config.dumped_prototypes or {}
+
+local function dumped(type_name, name)
+	return dumped_prototypes[type_name] ~= nil and dumped_prototypes[type_name][name] ~= nil
+end
+
+local function desaturate(c, desaturation)
 	if c == nil then
 		return nil
 	end
 
 	-- colors can be either named, on indexed
-	r = c.r or c[1] or 0
-	g = c.g or c[2] or 0
-	b = c.b or c[3] or 0
-	a = c.a or c[4]
+	local r = c.r or c[1] or 0
+	local g = c.g or c[2] or 0
+	local b = c.b or c[3] or 0
+	local a = c.a or c[4]
 
 	-- They can also be valued [0-1] or [0-255]
 	if r > 1 or g > 1 or b > 1 or (a or 1) > 1 then
@@ -19,11 +28,11 @@ local function desaturate(c, bri, sat)
 		end
 	end
 
-	-- Numbers taken from factorio's shader. Keep in sync with run-conversion.py
-	ret = {
-		r = (r*(0.3086 + 0.6914*sat) + g*(0.6094 - 0.6094*sat) + b*(0.0820 - 0.0820*sat)) * bri,
-		g = (r*(0.3086 - 0.3086*sat) + g*(0.6094 + 0.3906*sat) + b*(0.0820 - 0.0820*sat)) * bri,
-		b = (r*(0.3086 - 0.3086*sat) + g*(0.6094 - 0.6094*sat) + b*(0.0820 + 0.9180*sat)) * bri,
+	local m = map_colors.matrices[desaturation]
+	local ret = {
+		r = m[1]*r + m[2]*g + m[3]*b,
+		g = m[4]*r + m[5]*g + m[6]*b,
+		b = m[7]*r + m[8]*g + m[9]*b,
 		a = a,
 	}
 
@@ -40,6 +49,23 @@ local function desaturate(c, bri, sat)
 	return ret
 end
 
+-- Assign the colors desaturated at build time, each entry is a field path then
+-- its new color
+for type_name, prototypes in pairs(map_colors.precomputed or {}) do
+	for name, entries in pairs(prototypes) do
+		local prototype = data.raw[type_name] and data.raw[type_name][name]
+		for _, entry in ipairs(prototype and entries or {}) do
+			local parent = prototype
+			for i = 1, #entry - 2 do
+				parent = parent and parent[entry[i]]
+			end
+			if type(parent) == "table" then
+				parent[entry[#entry - 1]] = entry[#entry]
+			end
+		end
+	end
+end
+
 local function scale_table(table, a)
 	for key, value in pairs(table) do
 		table[key] = table[key] * a
@@ -47,18 +73,15 @@ local function scale_table(table, a)
 end
 
 for entity_group_name, entity_group in pairs(data.raw) do
-	for _, entity in pairs(entity_group) do
-		entity.map_color = desaturate(entity.map_color, 0.7, 0.1)
-		entity.friendly_map_color = desaturate(entity.friendly_map_color, 0.7, 0.1)
-		entity.enemy_map_color = desaturate(entity.enemy_map_color, 0.7, 0.1)
-
-		-- fixup the drawing of water
-		entity.effect_color = desaturate(entity.effect_color, 0.5, 0.6)
-		entity.effect_color_secondary = desaturate(entity.effect_color_secondary, 0.5, 0.3)
+	for entity_name, entity in pairs(entity_group) do
+		if not dumped(entity_group_name, entity_name) then
+			-- map colors, and the colors of water
+			for field, desaturation in pairs(map_colors.fields) do
+				entity[field] = desaturate(entity[field], desaturation)
+			end
+		end
 
 		if entity.foam_color ~= nil then
-			entity.foam_color = desaturate(entity.foam_color, 0.5, 0.6)
-
 			-- since we have made the tiles darker, we also must drop all of the thresholds
 			scale_table(entity.dark_threshold, 0.5)
 			scale_table(entity.reflection_threshold, 0.5)
@@ -79,19 +102,20 @@ end
 
 
 -- There are a bunch of default colors in UtilityConstants.chart for the map that we must desaturate too
-local function desaturate_table(t, sat, bri, postfix)
+local function desaturate_table(t, desaturation, postfix)
 	for k, v in pairs(t) do
 		if postfix == nil or k:sub(-#postfix) == postfix then
-			t[k] = desaturate(t[k], sat, bri)
+			t[k] = desaturate(t[k], desaturation)
 		end
 	end
 end
-desaturate_table(data.raw["utility-constants"].default.chart, 0.7, 0.1, "_color")
-desaturate_table(data.raw["utility-constants"].default.chart.default_color_by_type, 0.7, 0.1)
-desaturate_table(data.raw["utility-constants"].default.chart.default_friendly_color_by_type, 0.7, 0.1)
+if not dumped("utility-constants", "default") then
+	desaturate_table(data.raw["utility-constants"].default.chart, "map", "_color")
+	desaturate_table(data.raw["utility-constants"].default.chart.default_color_by_type, "map")
+	desaturate_table(data.raw["utility-constants"].default.chart.default_friendly_color_by_type, "map")
+end
 
 -- The entire screen flashes this colour on damage being taken
-data.raw["character"]["character"]["damage_hit_tint"] = desaturate(data.raw["character"]["character"]["damage_hit_tint"], 0.5, 0.6)
-
-
-
+if not dumped("character", "character") then
+	data.raw["character"]["character"]["damage_hit_tint"] = desaturate(data.raw["character"]["character"]["damage_hit_tint"], "water")
+end